@@ -3,26 +3,126 @@ import glob
 import json
 import os
 import re
-from typing import List
+from typing import Dict, Iterator, List, Set
 import zlib
 import schema_types as t
+from StashBoxEditLog import StashBoxEditLog
+from StashBoxHelperClasses import LinkSummary, link_summary
 
 STRFTIMEFORMAT = "%Y-%m-%d-%H-%M"
+# cacheDate of a cache that was never downloaded
+NO_CACHE_DATE = datetime(2020,1,1,1,1,1)
+# Once the journal grows past this size, the next save writes a new full snapshot instead
+JOURNAL_COMPACT_BYTES = 32 * 1024 * 1024
+# Size of the compressed chunks read while streaming a snapshot
+READ_CHUNK_BYTES = 1024 * 1024
 
 class StashBoxCache:
-    performers = []
+    """
+    Local copy of all performers of a StashBox instance.
+
+    Performer records are kept without their edit history. Edits embedded in the performers are moved to the edit log,
+    which getPerformerEdits reads them back from.
+    """
+    # Performers are indexed by id, dicts keep insertion order so getCache() is stable
+    performers : Dict[str, t.Performer]
     stashBoxInstance = ""
-    cacheDate = datetime(2020,1,1,1,1,1)
+    cacheDate = NO_CACHE_DATE
+    # Date of the snapshot file the journal applies to, None if the snapshot must be (re)written
+    snapshotDate : datetime = None
+    # False while a lazily loaded cache is still only on disk
+    loaded = True
+    # Query profile the performers were downloaded with, one of StashBoxWrapperGQLQueries.QUERY_PROFILES
+    profile = "history"
+    # Closing date of the latest edit included in the cache, as sent by the server. Refreshes download the edits closed after it
+    editWatermark : str = None
+    # Store of the performer edits, the histories returned by getPerformerEdits are read from it
+    editLog : StashBoxEditLog = None
+    # Link summary of each performer with StashBox links, by id. None until built or read from the links file of the snapshot
+    links : Dict[str, LinkSummary] = None
+    # Reverse index of the links: ids of the performers linking to each source performer, by instance name and source id
+    linkedIds : Dict[str, Dict[str, Set[str]]] = None
+    # Ids of the performers by lowercased name. None until findPerformersByName needs it
+    names : Dict[str, List[str]] = None
 
-    def __init__(self, stashBoxInstance : str) -> None:
+    def __init__(self, stashBoxInstance : str, journalCompactBytes : int = JOURNAL_COMPACT_BYTES) -> None:
         self.stashBoxInstance = stashBoxInstance
+        self.performers = {}
+        self.journalCompactBytes = journalCompactBytes
+        self.pendingJournal = []
+        self.journalChanges = []
     
     def getCache(self) -> List[t.Performer]:
-        return self.performers
+        self._ensureLoaded()
+        return list(self.performers.values())
+
+    def iterPerformers(self) -> Iterator[t.Performer]:
+        """
+        Iterates over all performers, for callers that only need a single pass
+
+        If the cache was loaded lazily, performers are streamed from the file one at a time and are not kept in memory
+        """
+        if self.loaded:
+            return iter(self.performers.values())
+        return self._iterPerformersFromFile()
+    
+    def setPerformers(self, performers : List[t.Performer]):
+        """
+        Replaces the whole content of the cache. Edit histories embedded in the performers are moved to the edit log
+        """
+        self.performers = {}
+        self.names = None
+        self.links = {}
+        self.linkedIds = {}
+        edits = []
+        for perf in performers:
+            self._storePerformer(perf, edits)
+            self._linkPerformer(perf)
+        self._logEdits(edits)
+        self.loaded = True
+        # The journal can't express a full reload, the next save must write a snapshot
+        self.snapshotDate = None
+        self.pendingJournal = []
+        self.journalChanges = []
+
+    def _storePerformer(self, performer : t.Performer, edits : List[t.PerformerEdit]):
+        """
+        Stores a performer record, and adds the edits embedded in it to edits
+        """
+        if "edits" in performer:
+            performer = dict(performer)
+            edits.extend(performer.pop("edits") or [])
+        self.performers[performer["id"]] = performer
+
+    def _logEdits(self, edits : List[t.PerformerEdit]):
+        if self.editLog is None or not edits:
+            return
+        added = self.editLog.addEdits(edits)
+        if added > 0:
+            print(f"{added} edits added to the edit log")
+
+    def _snapshotFilename(self, snapshotDate : datetime) -> str:
+        return f"Cache/{self.stashBoxInstance}_performers_cache_{snapshotDate.strftime(STRFTIMEFORMAT)}.json.zlib"
+
+    def _journalFilename(self, snapshotDate : datetime) -> str:
+        return f"Cache/{self.stashBoxInstance}_performers_journal_{snapshotDate.strftime(STRFTIMEFORMAT)}.jsonl"
+
+    def _infoFilename(self, snapshotDate : datetime) -> str:
+        return f"Cache/{self.stashBoxInstance}_performers_info_{snapshotDate.strftime(STRFTIMEFORMAT)}.json"
+
+    def _linksFilename(self, snapshotDate : datetime) -> str:
+        return f"Cache/{self.stashBoxInstance}_performers_links_{snapshotDate.strftime(STRFTIMEFORMAT)}.json.zlib"
     
-    def loadCacheFromFile(self):
+    def loadCacheFromFile(self, lazy = False):
+        """
+        Loads the latest snapshot and its journal
+
+        ### Parameters
+            - lazy (bool): Only read the cache date and the journal. Performers are then streamed from the file by iterPerformers,
+            and only loaded in memory when they are looked up or changed
+        """
         globName = f"Cache/{self.stashBoxInstance}_performers_cache_*.json.zlib"
-        earliest = datetime(2020,1,1,1,1,1)
+        earliest = NO_CACHE_DATE
         for name in glob.glob(globName):
             dateGrabber = re.compile(r".*performers_cache_(\d\d\d\d)-(\d\d)-(\d\d)-(\d\d)-(\d\d).json.zlib")
             dateStr = dateGrabber.match(name)
@@ -31,41 +131,436 @@ class StashBoxCache:
                 earliest = fileDate
         
         self.cacheDate = earliest
-        if earliest == datetime(2020,1,1,1,1,1):
+        if earliest == NO_CACHE_DATE:
             # There is no cache file yet
             return
         
-        dateCacheFile = earliest.strftime(STRFTIMEFORMAT)
-        filename = f"Cache/{self.stashBoxInstance}_performers_cache_{dateCacheFile}.json.zlib"
+        self.snapshotDate = earliest
+        # Snapshots written before query profiles existed were always complete
+        self.profile = "history"
+        self.editWatermark = None
+        if os.path.exists(self._infoFilename(self.snapshotDate)):
+            with open(self._infoFilename(self.snapshotDate), mode='r', encoding='utf-8') as info:
+                snapshotInfo = json.load(info)
+            self.profile = snapshotInfo.get("profile", "history")
+            self.editWatermark = snapshotInfo.get("editWatermark")
+        self.journalChanges = self._readJournal()
+        self.links = None
+        self.linkedIds = None
+        if os.path.exists(self._linksFilename(self.snapshotDate)):
+            with open(self._linksFilename(self.snapshotDate), mode='rb') as links:
+                self._setLinks(json.loads(zlib.decompress(links.read())))
+            for entry in self.journalChanges:
+                self._applyJournalLinks(entry)
+        self.loaded = False
+        if lazy:
+            print(f"Cache from {self.cacheDate} will be read from file when needed")
+            return
+
+        self._ensureLoaded()
+
+    def _ensureLoaded(self):
+        """
+        Loads a lazily loaded cache in memory, and applies the journal on top of it
+        """
+        if self.loaded:
+            return
+
+        self.performers = {}
+        self.names = None
+        edits = []
+        for perf in self._iterSnapshot(self._snapshotFilename(self.snapshotDate)):
+            self._storePerformer(perf, edits)
+        for entry in self.journalChanges:
+            self._applyJournalEntry(entry)
+        print(f"Cache contains {len(self.performers)} entries ({len(self.journalChanges)} changes replayed from journal)")
+        self.journalChanges = []
+        self.loaded = True
+
+        if len(edits) > 0:
+            # Snapshot from an older version with the histories embedded, write it again without them on the next save
+            self._logEdits(edits)
+            self.snapshotDate = None
+
+    def _iterSnapshot(self, filename : str) -> Iterator[t.Performer]:
+        """
+        Decompresses a snapshot file chunk by chunk, and parses its performers one at a time
+
+        Snapshots are written with one performer per line. Older snapshots written on a single line are parsed in one go
+        """
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS|32)
+        buffer = b""
+        legacyChunks = []
+        streaming = None
         with open(filename, mode='rb') as cache:
-            fileData = zlib.decompress(cache.read(), zlib.MAX_WBITS|32).decode()
-            self.performers = json.loads(fileData)
+            for chunk in iter(lambda: cache.read(READ_CHUNK_BYTES), b""):
+                data = decompressor.decompress(chunk)
+                if streaming is None and data:
+                    streaming = data.startswith(b"[\n")
+                if not streaming:
+                    legacyChunks.append(data)
+                    continue
+
+                lines = (buffer + data).split(b"\n")
+                buffer = lines.pop()
+                yield from self._parseSnapshotLines(lines)
+
+        if not streaming:
+            legacyChunks.append(decompressor.flush())
+            yield from json.loads(b"".join(legacyChunks).decode())
+            return
+        yield from self._parseSnapshotLines((buffer + decompressor.flush()).split(b"\n"))
+
+    @staticmethod
+    def _parseSnapshotLines(lines : List[bytes]) -> Iterator[t.Performer]:
+        for line in lines:
+            line = line.rstrip(b",")
+            if line not in (b"[", b"]", b""):
+                yield json.loads(line)
+
+    def _iterPerformersFromFile(self) -> Iterator[t.Performer]:
+        # The latest journal state of each changed performer, None if it was deleted
+        changed = {}
+        for entry in self.journalChanges:
+            changed[entry["id"]] = entry.get("performer")
+            for mergedId in entry.get("merged_ids", []):
+                changed[mergedId] = None
+
+        for perf in self._iterSnapshot(self._snapshotFilename(self.snapshotDate)):
+            if perf["id"] in changed:
+                perf = changed.pop(perf["id"])
+                if perf is None:
+                    continue
+            # Older snapshots embed the histories
+            perf.pop("edits", None)
+            yield perf
+
+        # Performers created since the snapshot
+        for perf in changed.values():
+            if perf is not None:
+                yield perf
+
+    def _readJournal(self) -> List[Dict]:
+        """
+        Reads the journal of the current snapshot, and moves cacheDate to the last save
+
+        Entries are only returned once a SAVE record follows them, so a save interrupted half-way is ignored
+
+        ### Returns
+            The committed journal entries, in order
+        """
+        journalFile = self._journalFilename(self.snapshotDate)
+        if not os.path.exists(journalFile):
+            return []
+
+        committed = []
+        uncommitted = []
+        committedOffset = 0
+        with open(journalFile, mode='rb') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Truncated last line from an interrupted save
+                    break
+                if entry["operation"] != "SAVE":
+                    uncommitted.append(entry)
+                    continue
+                committed.extend(uncommitted)
+                uncommitted = []
+                committedOffset = journal.tell()
+                self.cacheDate = datetime.fromisoformat(entry["date"])
+                self.editWatermark = entry.get("editWatermark", self.editWatermark)
+
+        if committedOffset < os.path.getsize(journalFile):
+            # Drop the leftovers of an interrupted save, so the next append starts on a clean line
+            with open(journalFile, mode='r+b') as journal:
+                journal.truncate(committedOffset)
+        return committed
+
+    def _applyJournalEntry(self, entry : Dict):
+        self._applyJournalLinks(entry)
+        if entry["operation"] == "DESTROY":
+            self.performers.pop(entry["id"], None)
+            return
+        self.performers[entry["id"]] = entry["performer"]
+        for mergedId in entry.get("merged_ids", []):
+            self.performers.pop(mergedId, None)
+
+    def _applyJournalLinks(self, entry : Dict):
+        if entry["operation"] == "DESTROY":
+            self._unlinkPerformer(entry["id"])
+            return
+        self._linkPerformer(entry["performer"])
+        for mergedId in entry.get("merged_ids", []):
+            self._unlinkPerformer(mergedId)
 
-        print(f"Cache contains {len(self.performers)} entries")
+    def _setLinks(self, links : Dict[str, LinkSummary]):
+        self.links = {}
+        self.linkedIds = {}
+        for performerId, summary in links.items():
+            self._indexLinks(performerId, summary)
+
+    def _indexLinks(self, performerId : str, summary : LinkSummary):
+        self.links[performerId] = summary
+        for instance, sourceIds in summary["sourceIds"].items():
+            for sourceId in sourceIds:
+                self.linkedIds.setdefault(instance, {}).setdefault(sourceId, set()).add(performerId)
+
+    def _linkPerformer(self, performer : t.Performer):
+        """
+        Updates the link summary of a performer, if the links are being tracked
+        """
+        if self.links is None:
+            return
+        self._unlinkPerformer(performer["id"])
+        summary = link_summary([url["url"] for url in performer.get("urls") or [] if url.get("url")])
+        if len(summary["instances"]) > 0:
+            self._indexLinks(performer["id"], summary)
+
+    def _unlinkPerformer(self, performerId : str):
+        if self.links is None:
+            return
+        summary = self.links.pop(performerId, None)
+        if summary is None:
+            return
+        for instance, sourceIds in summary["sourceIds"].items():
+            for sourceId in sourceIds:
+                targets = self.linkedIds[instance][sourceId]
+                targets.discard(performerId)
+                if len(targets) == 0:
+                    del self.linkedIds[instance][sourceId]
+
+    def _ensureLinks(self):
+        """
+        Builds the link summaries from the performers, when the snapshot has no links file
+        """
+        if self.links is not None:
+            return
+        self.links = {}
+        self.linkedIds = {}
+        for performer in self.iterPerformers():
+            self._linkPerformer(performer)
+
+    def getLinkSummary(self, performerId : str) -> LinkSummary:
+        """
+        Returns the StashBox instances a performer links to, the ids of the performers linked, and if there is more than one link
+        """
+        self._ensureLinks()
+        return self.links.get(performerId) or {"instances": [], "sourceIds": {}, "multiLink": False}
+
+    def findPerformerIdsLinkedTo(self, instance : str) -> Set[str]:
+        """
+        Returns the ids of the performers with at least one link to a performer of instance
+        """
+        self._ensureLinks()
+        return set([performerId for targets in self.linkedIds.get(instance, {}).values() for performerId in targets])
+
+    def _indexName(self, performerId : str, performer : t.Performer = None):
+        """
+        Moves a performer to the entry of its new name in the name index, if it is built. Must be called before self.performers
+        is updated
+
+        ### Parameters
+            - performerId (str): Id of the performer
+            - performer (t.Performer, optional): New state of the performer, None if it is removed
+        """
+        if self.names is None:
+            return
+        previous = self.performers.get(performerId)
+        if previous is not None:
+            namesakes = self.names.get((previous.get("name") or "").lower(), [])
+            if performerId in namesakes:
+                namesakes.remove(performerId)
+        if performer is not None:
+            self.names.setdefault((performer.get("name") or "").lower(), []).append(performerId)
+
+    def findPerformersByName(self, name : str) -> List[t.Performer]:
+        """
+        Returns the performers with this name, ignoring case
+        """
+        self._ensureLoaded()
+        if self.names is None:
+            self.names = {}
+            for performerId, performer in self.performers.items():
+                self.names.setdefault((performer.get("name") or "").lower(), []).append(performerId)
+        return [self.performers[performerId] for performerId in self.names.get(name.lower(), [])]
+
+    def findPerformersByUrl(self, url : str) -> List[t.Performer]:
+        return [perf for perf in self.iterPerformers() if url in [link["url"] for link in perf.get("urls") or []]]
 
     def getPerformerById(self, performerId) -> t.Performer:
-        # Return the first performer matching the id, or None if not found
-        return next((perf for perf in self.performers if perf.get("id") == performerId), None)
+        # Return the performer matching the id, or None if not found
+        self._ensureLoaded()
+        return self.performers.get(performerId)
+
+    def getPerformerEdits(self, performerId : str) -> List[t.PerformerEdit]:
+        """
+        Returns the edit history of a performer, read from the edit log
+        """
+        # Older snapshots move their embedded histories to the log when loaded
+        self._ensureLoaded()
+        if self.editLog is None:
+            return []
+        return self.editLog.getPerformerEdits(performerId)
+
+    def addPerformer(self, performer : t.Performer):
+        self._ensureLoaded()
+        self._logEdits(performer.pop("edits", None))
+        self._indexName(performer["id"], performer)
+        self.performers[performer["id"]] = performer
+        self._linkPerformer(performer)
+        self.pendingJournal.append({"operation": "CREATE", "id": performer["id"], "performer": performer})
     
-    def _getPerformerIdxById(self, performerId) -> t.Performer:
-        result = None
-        for idx, perf in enumerate(self.performers):
-            if perf['id'] == performerId:
-                return idx
-        
-        #result = [idx for idx, perf in enumerate(self.performers) if perf.id == performerId][0]
-        return result
+    def replacePerformer(self, performer : t.Performer, mergedIds : List[str] = None):
+        """
+        Replaces the cached record with the same id as performer
+
+        ### Parameters
+            - performer (t.Performer): The new state of the performer. If it has "edits", they are added to the edit log
+            - mergedIds ([str], optional): Ids of the performers merged into this one, they are removed from the cache
+        """
+        self._ensureLoaded()
+        self._logEdits(performer.pop("edits", None))
+        self._indexName(performer["id"], performer)
+        self.performers[performer["id"]] = performer
+        self._linkPerformer(performer)
+        entry = {"operation": "MODIFY", "id": performer["id"], "performer": performer}
+        if mergedIds:
+            for mergedId in mergedIds:
+                self._indexName(mergedId)
+                self.performers.pop(mergedId, None)
+                self._unlinkPerformer(mergedId)
+            entry["operation"] = "MERGE"
+            entry["merged_ids"] = mergedIds
+        self.pendingJournal.append(entry)
     
     def deletePerformerById(self, performerId : str):
-        deletedIdx = self._getPerformerIdxById(performerId)
-        del self.performers[deletedIdx]
+        # Merged / deleted performers may already be gone from the cache
+        self._ensureLoaded()
+        self._indexName(performerId)
+        self.performers.pop(performerId, None)
+        self._unlinkPerformer(performerId)
+        self.pendingJournal.append({"operation": "DESTROY", "id": performerId})
 
     def saveCacheToFile(self):
-        dateNow = datetime.now().strftime(STRFTIMEFORMAT)
-        filename = f"Cache/{self.stashBoxInstance}_performers_cache_{dateNow}.json.zlib"
+        """
+        Persists the cache, as it was on self.cacheDate
+
+        Changes since the last save are appended to the journal of the current snapshot.
+        A full snapshot is only written when there is none yet, or once the journal is over journalCompactBytes
+        """
+        if self.snapshotDate is not None:
+            journalFile = self._journalFilename(self.snapshotDate)
+            journalSize = os.path.getsize(journalFile) if os.path.exists(journalFile) else 0
+            if journalSize < self.journalCompactBytes:
+                self._appendJournal(journalFile)
+                return
+
+        self._ensureLoaded()
+        filename = self._snapshotFilename(self.cacheDate)
         print(f"Saving cache to file: {filename}")
         os.makedirs(os.path.dirname(filename), exist_ok=True)
         with open(filename, mode='wb') as file:
-            encoded = json.dumps(self.performers).encode()
-            compressed = zlib.compress(encoded)
-            file.write(compressed)
\ No newline at end of file
+            # One performer per line, so the file can be read back one performer at a time
+            compressor = zlib.compressobj()
+            file.write(compressor.compress(b"[\n"))
+            for idx, perf in enumerate(self.performers.values()):
+                separator = b",\n" if idx > 0 else b""
+                file.write(compressor.compress(separator + json.dumps(perf).encode()))
+            file.write(compressor.compress(b"\n]"))
+            file.write(compressor.flush())
+        with open(self._infoFilename(self.cacheDate), mode='w', encoding='utf-8') as info:
+            json.dump({"profile": self.profile, "editWatermark": self.editWatermark}, info)
+        self._ensureLinks()
+        with open(self._linksFilename(self.cacheDate), mode='wb') as links:
+            links.write(zlib.compress(json.dumps(self.links).encode()))
+
+        if self.snapshotDate is not None and os.path.exists(self._journalFilename(self.snapshotDate)):
+            # The old journal is now part of the new snapshot
+            os.remove(self._journalFilename(self.snapshotDate))
+        self.snapshotDate = datetime.strptime(self.cacheDate.strftime(STRFTIMEFORMAT), STRFTIMEFORMAT)
+        self.pendingJournal = []
+
+    def _appendJournal(self, journalFile : str):
+        print(f"Saving {len(self.pendingJournal)} changes to journal: {journalFile}")
+        os.makedirs(os.path.dirname(journalFile), exist_ok=True)
+        with open(journalFile, mode='a', encoding='utf-8') as journal:
+            for entry in self.pendingJournal:
+                journal.write(json.dumps(entry) + "\n")
+            journal.write(json.dumps({"operation": "SAVE", "date": self.cacheDate.isoformat(), "editWatermark": self.editWatermark}) + "\n")
+        self.pendingJournal = []
+
+
+class StashBoxDownloadCheckpoint:
+    """
+    Pages of an ongoing full download, appended to a file as they are received so an interrupted download can resume.
+
+    The first line records when the download started, its query profile and the edit watermark at that time,
+    each following line is one page: {"page": int, "count": int, "performers": [...]}
+    """
+    filename : str
+    started : datetime = None
+    profile : str
+    # Closing date of the latest edit when the download started, replaced by the saved one when resuming
+    editWatermark : str = None
+
+    def __init__(self, stashBoxInstance : str, profile : str = "history", editWatermark : str = None) -> None:
+        self.filename = f"Cache/{stashBoxInstance}_performers_download.partial.jsonl"
+        self.profile = profile
+        self.editWatermark = editWatermark
+
+    def loadPages(self) -> Dict[int, Dict]:
+        """
+        Reads the pages saved by a previous, interrupted download. Starts a new checkpoint if there is none.
+
+        ### Returns
+            The saved pages, by page number
+        """
+        pages = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, mode='rb') as checkpoint:
+                try:
+                    header = json.loads(checkpoint.readline())
+                except json.JSONDecodeError:
+                    header = {}
+            if header.get("profile", "history") != self.profile:
+                print(f"Previous download used the {header.get('profile', 'history')} query profile, starting again")
+                os.remove(self.filename)
+
+        if not os.path.exists(self.filename):
+            self.started = datetime.now()
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(self.filename, mode='w', encoding='utf-8') as checkpoint:
+                checkpoint.write(json.dumps({"started": self.started.isoformat(), "profile": self.profile, "editWatermark": self.editWatermark}) + "\n")
+            return pages
+
+        validOffset = 0
+        with open(self.filename, mode='rb') as checkpoint:
+            for line in checkpoint:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Page interrupted while being written
+                    break
+                validOffset = checkpoint.tell()
+                if "started" in record:
+                    self.started = datetime.fromisoformat(record["started"])
+                    self.editWatermark = record.get("editWatermark")
+                else:
+                    pages[record["page"]] = record
+
+        if validOffset < os.path.getsize(self.filename):
+            with open(self.filename, mode='r+b') as checkpoint:
+                checkpoint.truncate(validOffset)
+
+        print(f"Resuming download started {self.started}, {len(pages)} pages already downloaded")
+        return pages
+
+    def savePage(self, page : int, count : int, performers : List[t.Performer]):
+        with open(self.filename, mode='a', encoding='utf-8') as checkpoint:
+            checkpoint.write(json.dumps({"page": page, "count": count, "performers": performers}) + "\n")
+
+    def clear(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
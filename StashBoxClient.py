@@ -0,0 +1,477 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_REQUESTS_PER_SECOND = 1.0
+# Status codes meaning the server is overloaded, and requests should slow down
+THROTTLE_STATUS_CODES = [429, 500, 502, 503, 504]
+# (connect, read) timeouts in seconds, for each kind of operation
+DEFAULT_TIMEOUTS = {
+    "page" : (10, 120),
+    "lookup" : (10, 30),
+    "image" : (10, 30),
+    "upload" : (10, 60)
+}
+# Status codes worth trying again, the server may answer correctly later
+RETRYABLE_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+# Status codes returned before the request was processed, even a mutation can be sent again
+UNPROCESSED_STATUS_CODES = [408, 429, 503]
+
+class StashBoxError(Exception):
+    """
+    Failed call to a StashBox server
+    """
+    retryable : bool
+    processed : bool
+
+    def __init__(self, message : str, retryable : bool = False, processed : bool = True) -> None:
+        """
+        ### Parameters
+            - message (str): Description of the error
+            - retryable (bool): The same call may succeed if tried again later
+            - processed (bool): The server may have processed the request, so it must not be sent again unless it is idempotent
+        """
+        super().__init__(message)
+        self.retryable = retryable
+        self.processed = processed
+
+def classifyRequestException(exception : requests.RequestException) -> StashBoxError:
+    """
+    Converts a transport error from requests to a StashBoxError
+    """
+    if isinstance(exception, requests.ConnectTimeout):
+        # The connection was never established
+        return StashBoxError(f"Connection timed out: {exception}", retryable=True, processed=False)
+    if isinstance(exception, (requests.ConnectionError, requests.Timeout)):
+        return StashBoxError(f"Connection error: {exception}", retryable=True)
+    return StashBoxError(f"Request error: {exception}")
+
+def checkResponseStatus(response : requests.Response):
+    """
+    Raises a StashBoxError if the response is not a success
+    """
+    if response.status_code == 200:
+        return
+    raise StashBoxError(
+        f"HTTP {response.status_code}",
+        retryable=response.status_code in RETRYABLE_STATUS_CODES,
+        processed=response.status_code not in UNPROCESSED_STATUS_CODES
+    )
+
+class RetryPolicy:
+    """
+    Retries failed calls classified as retryable, with an exponential backoff and random jitter between attempts.
+
+    The number of retries is also limited for the whole run, so a broken server fails fast instead of being retried forever.
+    """
+    def __init__(self, maxAttempts : int = 5, baseDelay : float = 2, maxDelay : float = 120, runBudget : int = 200) -> None:
+        """
+        ### Parameters
+            - maxAttempts (int): Maximum number of attempts for a single call
+            - baseDelay (float): Seconds to wait before the first retry, doubled at each attempt
+            - maxDelay (float): Maximum number of seconds between two attempts
+            - runBudget (int): Maximum number of retries for all calls of the run
+        """
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.runBudget = runBudget
+        self.lock = threading.Lock()
+
+    def backoff(self, attempt : int) -> float:
+        return random.uniform(self.baseDelay / 2, min(self.maxDelay, self.baseDelay * 2 ** attempt))
+
+    def _takeRetry(self, error : StashBoxError, attempt : int, idempotent : bool) -> bool:
+        if not error.retryable or attempt + 1 >= self.maxAttempts:
+            return False
+        if error.processed and not idempotent:
+            return False
+        with self.lock:
+            if self.runBudget <= 0:
+                print("Retry budget for this run is exhausted, not retrying")
+                return False
+            self.runBudget -= 1
+        return True
+
+    def _retryDelay(self, exception : Exception, attempt : int, idempotent : bool) -> float:
+        """
+        Returns the number of seconds to wait before the next attempt, or raises the error if the call can't be retried
+        """
+        if isinstance(exception, requests.RequestException):
+            error, cause = classifyRequestException(exception), exception
+        else:
+            error, cause = exception, None
+
+        if not self._takeRetry(error, attempt, idempotent):
+            raise error from cause
+        delay = self.backoff(attempt)
+        if remainingTime() is not None and remainingTime() < delay:
+            # Waiting would go past the deadline anyway
+            raise error from cause
+        print(f"{error} -- Retrying in {delay:.1f}s (attempt {attempt + 2} of {self.maxAttempts})")
+        return delay
+
+    def run(self, call : Callable, idempotent : bool = True):
+        """
+        Calls call() until it succeeds, or fails with an error that can't be retried
+
+        ### Parameters
+            - call (Callable): Function sending the request, raising a StashBoxError or a requests exception on failure
+            - idempotent (bool): The request can safely be processed twice by the server (queries, downloads)
+        """
+        attempt = 0
+        while True:
+            try:
+                return call()
+            except (requests.RequestException, StashBoxError) as e:
+                delay = self._retryDelay(e, attempt, idempotent)
+            attempt += 1
+            time.sleep(delay)
+
+    async def runAsync(self, call : Callable[[], Awaitable], idempotent : bool = True):
+        """
+        Same as run, for a coroutine function. Waiting between attempts doesn't block the event loop
+        """
+        attempt = 0
+        while True:
+            try:
+                return await call()
+            except (requests.RequestException, StashBoxError) as e:
+                delay = self._retryDelay(e, attempt, idempotent)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+RETRY_POLICY = RetryPolicy()
+
+# A context variable rather than a thread local, so the deadline also applies to asyncio tasks started inside the block
+_DEADLINE : ContextVar[float] = ContextVar("deadline", default=None)
+
+@contextmanager
+def requestDeadline(seconds : float = None):
+    """
+    Limits the total time of all requests sent by the current thread inside the with block, retries included.
+
+    Once the deadline has passed, requests fail with a StashBoxError instead of being sent. Does nothing if seconds is None
+    """
+    previous = _DEADLINE.get()
+    token = None
+    if seconds is not None:
+        token = _DEADLINE.set(time.monotonic() + seconds if previous is None else min(previous, time.monotonic() + seconds))
+    try:
+        yield
+    finally:
+        if token is not None:
+            _DEADLINE.reset(token)
+
+def remainingTime() -> float:
+    """
+    Returns the number of seconds left before the deadline of the current thread, or None if there is no deadline
+    """
+    end = _DEADLINE.get()
+    return end - time.monotonic() if end is not None else None
+
+class RateLimiter:
+    """
+    Token bucket limiting the number of requests sent to a server.
+
+    The rate is halved every time the server reports it is overloaded, and increases back towards maxRate with each successful request.
+    A Retry-After sent by the server blocks all requests until it has passed.
+    """
+    maxRate : float
+    rate : float
+    burst : float
+
+    def __init__(self, maxRate : float, burst : float = 1) -> None:
+        """
+        ### Parameters
+            - maxRate (float): Maximum number of requests per second
+            - burst (float): Number of requests that can be sent at once after a pause
+        """
+        self.maxRate = maxRate
+        self.minRate = maxRate / 32
+        self.rate = maxRate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blockedUntil = 0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token for a request
+
+        ### Returns
+            The number of seconds to wait before sending the request
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens can go negative, requests then queue up behind each other
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate, self.blockedUntil - now)
+
+    def acquire(self):
+        time.sleep(self.reserve())
+
+    def reportSuccess(self):
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + self.maxRate / 10)
+
+    def reportThrottled(self, retryAfter : float = None):
+        with self.lock:
+            self.rate = max(self.minRate, self.rate / 2)
+            if retryAfter is not None:
+                self.blockedUntil = max(self.blockedUntil, time.monotonic() + retryAfter)
+        print(f"Server is overloaded, slowing down to {self.rate:.2f} requests per second")
+
+def parseRetryAfter(response : requests.Response) -> float:
+    """
+    Returns the number of seconds requested by the Retry-After header, or None
+    """
+    retryAfter = response.headers.get("Retry-After")
+    if retryAfter is None:
+        return None
+    try:
+        return float(retryAfter)
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(retryAfter) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class StashBoxClient:
+    """
+    HTTP client for a StashBox endpoint.
+
+    Keeps a pooled session, so connections are reused between calls instead of opening a new TCP + TLS connection each time.
+    Requests to the endpoint go through its RateLimiter, with the connect / read timeouts of their kind of operation.
+
+    Idempotent reads can be hedged: if no answer came after hedgeAfter seconds, the same request is sent again and the first answer is used.
+    """
+    endpoint : Dict
+    session : requests.Session
+    rateLimiter : RateLimiter
+    timeouts : Dict[str, Tuple[float, float]]
+    hedgeAfter : float = None
+
+    def __init__(self, endpoint : Dict = None, poolSize : int = DEFAULT_POOL_SIZE, requestsPerSecond : float = None, timeouts : Dict = None, hedgeAfter : float = None) -> None:
+        """
+        ### Parameters
+            - endpoint (Dict, optional): The StashBox endpoint. Without it, the client can only be used for plain downloads (no API key is sent)
+            - poolSize (int): Maximum number of connections kept open
+            - requestsPerSecond (float, optional): Maximum rate of requests. Not limited if None
+            - timeouts (Dict, optional): (connect, read) timeouts by kind of operation, replacing the matching DEFAULT_TIMEOUTS
+            - hedgeAfter (float, optional): Seconds after which a hedged read is sent a second time. No hedging if None
+        """
+        self.endpoint = endpoint
+        self.rateLimiter = RateLimiter(requestsPerSecond) if requestsPerSecond else None
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.hedgeAfter = hedgeAfter
+        self.executor = ThreadPoolExecutor(max_workers=poolSize) if hedgeAfter is not None else None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Accept-Encoding": "gzip, deflate",
+            "Accept": "application/json",
+            "Connection": "keep-alive",
+            "DNT": "1"
+        })
+        if endpoint is not None:
+            self.session.headers["ApiKey"] = endpoint['api_key']
+
+    def post(self, **kwargs) -> requests.Response:
+        return self.request("POST", self.endpoint['endpoint'], **kwargs)
+
+    def get(self, url : str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def request(self, method : str, url : str, kind : str = "lookup", hedge : bool = False, **kwargs) -> requests.Response:
+        """
+        Sends a request
+
+        ### Parameters
+            - method (str): HTTP method
+            - url (str): Target url
+            - kind (str): Kind of operation, one of DEFAULT_TIMEOUTS keys, sets the timeouts of the request
+            - hedge (bool): The request is an idempotent read that can be hedged
+        """
+        kwargs["timeout"] = self._timeout(kind)
+        if not hedge or self.hedgeAfter is None:
+            return self._send(method, url, **kwargs)
+
+        # Worker threads don't inherit the caller's context, run each attempt in a copy so it sees the deadline
+        first = self.executor.submit(copy_context().run, self._send, method, url, **kwargs)
+        done, _ = wait([first], timeout=self.hedgeAfter)
+        if done:
+            return first.result()
+
+        print(f"No answer after {self.hedgeAfter}s, sending a hedged request")
+        pending = {first, self.executor.submit(copy_context().run, self._send, method, url, **kwargs)}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+        raise error
+
+    def _timeout(self, kind : str) -> Tuple[float, float]:
+        connect, read = self.timeouts[kind]
+        remaining = remainingTime()
+        if remaining is not None:
+            if remaining <= 0:
+                raise StashBoxError("Deadline exceeded", processed=False)
+            connect, read = min(connect, remaining), min(read, remaining)
+        return (connect, read)
+
+    def _send(self, method : str, url : str, **kwargs) -> requests.Response:
+        time.sleep(self._reserve())
+        return self._sendNow(method, url, **kwargs)
+
+    def _reserve(self) -> float:
+        """
+        Takes a token from the rate limiter, and returns the number of seconds to wait before sending the request
+        """
+        if self.rateLimiter is None:
+            return 0
+        delay = self.rateLimiter.reserve()
+        if remainingTime() is not None and remainingTime() < delay:
+            raise StashBoxError("Deadline exceeded", processed=False)
+        return delay
+
+    def _sendNow(self, method : str, url : str, **kwargs) -> requests.Response:
+        if self.rateLimiter is None:
+            return self.session.request(method, url, **kwargs)
+
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.Timeout:
+            self.rateLimiter.reportThrottled()
+            raise
+
+        if response.status_code in THROTTLE_STATUS_CODES:
+            self.rateLimiter.reportThrottled(parseRetryAfter(response))
+        else:
+            self.rateLimiter.reportSuccess()
+        return response
+
+_CLIENTS : Dict[str, StashBoxClient] = {}
+
+def getClient(endpoint : Dict) -> StashBoxClient:
+    """
+    Returns the shared client of a StashBox endpoint, creating it on first use
+    """
+    if endpoint['endpoint'] not in _CLIENTS:
+        _CLIENTS[endpoint['endpoint']] = StashBoxClient(
+            endpoint,
+            endpoint.get('pool_size', DEFAULT_POOL_SIZE),
+            endpoint.get('requests_per_second', DEFAULT_REQUESTS_PER_SECOND),
+            endpoint.get('timeouts'),
+            endpoint.get('hedge_after')
+        )
+    return _CLIENTS[endpoint['endpoint']]
+
+_DOWNLOAD_CLIENT : StashBoxClient = None
+
+def getDownloadClient() -> StashBoxClient:
+    """
+    Returns the shared client used to download images, which doesn't send any API key
+    """
+    global _DOWNLOAD_CLIENT
+    if _DOWNLOAD_CLIENT is None:
+        _DOWNLOAD_CLIENT = StashBoxClient()
+    return _DOWNLOAD_CLIENT
+
+class AsyncStashBoxClient:
+    """
+    Asyncio interface of a StashBoxClient.
+
+    Requests are sent from worker threads through the pooled session of the client, and share its RateLimiter.
+    A semaphore limits the number of requests in flight for the endpoint, waiting for a slot or a token doesn't block the event loop.
+    """
+    client : StashBoxClient
+    maxConcurrency : int
+
+    def __init__(self, client : StashBoxClient, maxConcurrency : int = DEFAULT_POOL_SIZE) -> None:
+        """
+        ### Parameters
+            - client (StashBoxClient): The client sending the requests
+            - maxConcurrency (int): Maximum number of requests in flight at once
+        """
+        self.client = client
+        self.maxConcurrency = maxConcurrency
+        self._semaphores = {}
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # asyncio objects belong to one event loop, and each asyncio.run() creates a new one
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores = {loop : asyncio.Semaphore(self.maxConcurrency)}
+        return self._semaphores[loop]
+
+    async def post(self, **kwargs) -> requests.Response:
+        return await self.request("POST", self.client.endpoint['endpoint'], **kwargs)
+
+    async def get(self, url : str, **kwargs) -> requests.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def request(self, method : str, url : str, kind : str = "lookup", **kwargs) -> requests.Response:
+        """
+        Sends a request
+
+        ### Parameters
+            - method (str): HTTP method
+            - url (str): Target url
+            - kind (str): Kind of operation, one of DEFAULT_TIMEOUTS keys, sets the timeouts of the request
+        """
+        async with self._semaphore():
+            kwargs["timeout"] = self.client._timeout(kind)
+            await asyncio.sleep(self.client._reserve())
+            return await asyncio.to_thread(self.client._sendNow, method, url, **kwargs)
+
+_ASYNC_CLIENTS : Dict[str, AsyncStashBoxClient] = {}
+
+def getAsyncClient(endpoint : Dict) -> AsyncStashBoxClient:
+    """
+    Returns the shared asyncio client of a StashBox endpoint, using the same session and rate limiter as getClient(endpoint)
+    """
+    if endpoint['endpoint'] not in _ASYNC_CLIENTS:
+        _ASYNC_CLIENTS[endpoint['endpoint']] = AsyncStashBoxClient(
+            getClient(endpoint),
+            endpoint.get('max_concurrency', endpoint.get('pool_size', DEFAULT_POOL_SIZE))
+        )
+    return _ASYNC_CLIENTS[endpoint['endpoint']]
+
+_ASYNC_DOWNLOAD_CLIENT : AsyncStashBoxClient = None
+
+def getAsyncDownloadClient() -> AsyncStashBoxClient:
+    """
+    Returns the shared asyncio client used to download images
+    """
+    global _ASYNC_DOWNLOAD_CLIENT
+    if _ASYNC_DOWNLOAD_CLIENT is None:
+        _ASYNC_DOWNLOAD_CLIENT = AsyncStashBoxClient(getDownloadClient())
+    return _ASYNC_DOWNLOAD_CLIENT
+
+def runSync(coroutine : Awaitable):
+    """
+    Runs a coroutine from synchronous code, and returns its result
+    """
+    return asyncio.run(coroutine)
@@ -0,0 +1,192 @@
+from datetime import datetime
+import json
+import os
+import struct
+from typing import Dict, List, Tuple
+import zlib
+import schema_types as t
+
+# Each record starts with the lengths of its header and body
+RECORD_HEADER = struct.Struct("<II")
+# Key of the references replacing the performer fragments nested in logged edits
+FRAGMENT_REF = "$ref"
+
+def normaliseClosedDate(closed : str) -> str:
+    """
+    Converts a closing date sent by the server to a string that sorts in date order, with or without fractional seconds
+    """
+    try:
+        return datetime.strptime(closed, "%Y-%m-%dT%H:%M:%S.%fZ").isoformat(timespec="microseconds")
+    except ValueError:
+        return datetime.strptime(closed, "%Y-%m-%dT%H:%M:%SZ").isoformat(timespec="microseconds")
+
+class StashBoxEditLog:
+    """
+    Append-only local store of the applied performer edits of a StashBox instance.
+
+    Each record is a small JSON header followed by a compressed body, so the indexes can be rebuilt on load without
+    decompressing anything. Edit records have an (id, target, closed, operation, status, applied) header, and are only read
+    from disk when asked for. An edit logged again with another status is appended as a new version, the latest one is returned.
+
+    The performer fragments nested in edits (target, merge_sources) are stored once, in fragment records with a
+    (fragment, checksum) header, and replaced by {"$ref": id} in the edits. A fragment is only written again when it changed,
+    the latest version is the one returned.
+    """
+    filename : str
+    # Position and length of the compressed body of each edit, by edit id
+    offsets : Dict[str, Tuple[int, int]]
+    # Ids of the edits of each performer, by target id
+    byTarget : Dict[str, List[str]]
+    # (status, applied, closed) of the latest version of each edit, by edit id
+    states : Dict[str, Tuple[str, bool, str]]
+    # Position, length and checksum of the latest version of each performer fragment, by performer id
+    fragments : Dict[str, Tuple[int, int, int]]
+    loaded = False
+
+    def __init__(self, stashBoxInstance : str, filename : str = None) -> None:
+        self.filename = filename if filename is not None else f"Cache/{stashBoxInstance}_performer_edits.bin"
+        self.offsets = {}
+        self.byTarget = {}
+        self.states = {}
+        self.fragments = {}
+
+    def _ensureLoaded(self):
+        """
+        Reads the record headers, and drops the end of a record interrupted while being written
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+        if not os.path.exists(self.filename):
+            return
+
+        validOffset = 0
+        with open(self.filename, mode='rb') as log:
+            while True:
+                lengths = log.read(RECORD_HEADER.size)
+                if len(lengths) < RECORD_HEADER.size:
+                    break
+                headerLength, bodyLength = RECORD_HEADER.unpack(lengths)
+                try:
+                    header = json.loads(log.read(headerLength))
+                except json.JSONDecodeError:
+                    break
+                bodyOffset = log.tell()
+                if log.seek(bodyLength, os.SEEK_CUR) > os.path.getsize(self.filename):
+                    break
+                self._index(header, bodyOffset, bodyLength)
+                validOffset = log.tell()
+
+        if validOffset < os.path.getsize(self.filename):
+            with open(self.filename, mode='r+b') as log:
+                log.truncate(validOffset)
+        print(f"Edit log contains {len(self.offsets)} edits")
+
+    def _index(self, header : Dict, bodyOffset : int, bodyLength : int):
+        if "fragment" in header:
+            self.fragments[header["fragment"]] = (bodyOffset, bodyLength, header["checksum"])
+            return
+        if header["id"] not in self.offsets and header.get("target") is not None:
+            self.byTarget.setdefault(header["target"], []).append(header["id"])
+        self.offsets[header["id"]] = (bodyOffset, bodyLength)
+        self.states[header["id"]] = (header.get("status"), header.get("applied"), header.get("closed"))
+
+    def _writeRecord(self, log, header : Dict, body : bytes):
+        encodedHeader = json.dumps(header).encode()
+        log.write(RECORD_HEADER.pack(len(encodedHeader), len(body)) + encodedHeader)
+        bodyOffset = log.tell()
+        log.write(body)
+        self._index(header, bodyOffset, len(body))
+
+    def _toRef(self, log, fragment : t.Performer) -> Dict:
+        """
+        Writes a performer fragment if it changed since its latest version, and returns the reference replacing it
+        """
+        if fragment is None or FRAGMENT_REF in fragment:
+            return fragment
+        encoded = json.dumps(fragment, sort_keys=True).encode()
+        checksum = zlib.crc32(encoded)
+        if self.fragments.get(fragment["id"], (0, 0, None))[2] != checksum:
+            self._writeRecord(log, {"fragment": fragment["id"], "checksum": checksum}, zlib.compress(encoded))
+        return {FRAGMENT_REF: fragment["id"]}
+
+    def addEdits(self, edits : List[t.PerformerEdit]) -> int:
+        """
+        Appends the edits that are not in the log yet, and a new version of the logged edits whose status changed,
+        e.g. pending when first seen in a performer history and accepted since
+
+        ### Returns
+            The number of edits added or updated
+        """
+        self._ensureLoaded()
+        added = 0
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        with open(self.filename, mode='ab') as log:
+            for edit in edits:
+                state = (edit.get("status"), edit.get("applied"), edit.get("closed"))
+                if self.states.get(edit["id"]) == state:
+                    continue
+                header = {
+                    "id": edit["id"],
+                    "target": (edit.get("target") or {}).get("id"),
+                    "closed": edit.get("closed"),
+                    "operation": edit.get("operation"),
+                    "status": edit.get("status"),
+                    "applied": edit.get("applied")
+                }
+                edit = dict(edit)
+                if "target" in edit:
+                    edit["target"] = self._toRef(log, edit["target"])
+                if edit.get("merge_sources"):
+                    edit["merge_sources"] = [self._toRef(log, source) for source in edit["merge_sources"]]
+                self._writeRecord(log, header, zlib.compress(json.dumps(edit).encode()))
+                added += 1
+        return added
+
+    def _readEdits(self, editIds : List[str]) -> List[t.PerformerEdit]:
+        if len(editIds) == 0:
+            return []
+        edits = []
+        # Each fragment is only read once, whatever the number of edits it appears in
+        fragments = {}
+        with open(self.filename, mode='rb') as log:
+            def fromRef(ref):
+                if ref is None or FRAGMENT_REF not in ref:
+                    return ref
+                fragmentId = ref[FRAGMENT_REF]
+                if fragmentId not in fragments:
+                    fragments[fragmentId] = {"id": fragmentId}
+                    if fragmentId in self.fragments:
+                        offset, length, _ = self.fragments[fragmentId]
+                        log.seek(offset)
+                        fragments[fragmentId] = json.loads(zlib.decompress(log.read(length)).decode())
+                return fragments[fragmentId]
+
+            for editId in editIds:
+                offset, length = self.offsets[editId]
+                log.seek(offset)
+                edit = json.loads(zlib.decompress(log.read(length)).decode())
+                if "target" in edit:
+                    edit["target"] = fromRef(edit["target"])
+                if edit.get("merge_sources"):
+                    edit["merge_sources"] = [fromRef(source) for source in edit["merge_sources"]]
+                edits.append(edit)
+        return edits
+
+    def getPerformerEdits(self, performerId : str) -> List[t.PerformerEdit]:
+        """
+        Returns the edits targeting a performer, oldest first
+        """
+        self._ensureLoaded()
+        edits = self._readEdits(self.byTarget.get(performerId, []))
+        edits.sort(key=lambda edit: normaliseClosedDate(edit["closed"]) if edit.get("closed") else "")
+        return edits
+
+    def getEditIdsClosedAt(self, closed : str) -> List[str]:
+        """
+        Returns the ids of the applied edits closed at a date, with or without fractional seconds
+        """
+        self._ensureLoaded()
+        closed = normaliseClosedDate(closed)
+        return [editId for editId, (_, applied, editClosed) in self.states.items()
+                if applied and editClosed is not None and normaliseClosedDate(editClosed) == closed]
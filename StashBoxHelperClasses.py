@@ -1,5 +1,6 @@
 from enum import Enum
-from typing import TypedDict
+import re
+from typing import Dict, List, Tuple, TypedDict
 from urllib.parse import urlparse, urlunparse 
 
 StashSource = Enum('StashSource', 'STASHDB PMVSTASH FANSDB')
@@ -10,6 +11,29 @@ PerformerUploadConfig = TypedDict('PerformerUploadConfig', {
     'comment':str
 })
 
+LinkSummary = TypedDict('LinkSummary', {
+    'instances': List[str],
+    'sourceIds': Dict[str, List[str]],
+    'multiLink': bool
+})
+
+# Performer pages of each StashBox instance, with the hostnames they are served from
+STASHBOX_PERFORMER_LINKS = {
+    StashSource.PMVSTASH : {
+        "hosts" : ["pmvstash.org"],
+        "regex" : re.compile(r"^https?:\/\/pmvstash\.org\/performers\/.+")
+    },
+    StashSource.STASHDB : {
+        "hosts" : ["stashdb.org"],
+        "regex" : re.compile(r"^https:\/\/stashdb\.org\/performers\/[a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12}")
+    },
+    StashSource.FANSDB : {
+        "hosts" : ["fansdb.cc", "fansdb.xyz"],
+        "regex" : re.compile(r"^https?:\/\/(?:www\.)?fansdb\.(?:cc|xyz)\/performers\/.+")
+    }
+}
+_STASHBOX_BY_HOST = {host: source for source, link in STASHBOX_PERFORMER_LINKS.items() for host in link["hosts"]}
+
 def normalise_url(url):
     '''Returns a normalised URL to allow comparison'''
     # Parse the URL into components
@@ -28,4 +52,37 @@ def normalise_url(url):
         ""
     ))
     
-    return normalized_url
\ No newline at end of file
+    return normalized_url
+
+def url_host_key(url: str) -> str:
+    '''Returns the lowercased hostname of a url without "www.", or None if it can't be parsed'''
+    try:
+        host = urlparse(url.strip()).hostname
+    except ValueError:
+        return None
+    if host is None:
+        return None
+    return host[4:] if host.startswith("www.") else host
+
+def stashbox_link(url: str) -> Tuple[StashSource, str]:
+    '''Returns the StashBox instance and the performer id a url links to, or (None, None) if it is not a StashBox performer link'''
+    source = _STASHBOX_BY_HOST.get(url_host_key(url or ""))
+    if source is None or not STASHBOX_PERFORMER_LINKS[source]["regex"].match(url):
+        return (None, None)
+    return (source, url.split('/').pop())
+
+def link_summary(urls: List[str]) -> LinkSummary:
+    '''Summarises the StashBox links among the urls of a performer'''
+    summary = {"instances": [], "sourceIds": {}, "multiLink": False}
+    count = 0
+    for url in urls:
+        source, performer_id = stashbox_link(url)
+        if source is None:
+            continue
+        count += 1
+        if source.name not in summary["instances"]:
+            summary["instances"].append(source.name)
+        summary["sourceIds"].setdefault(source.name, []).append(performer_id)
+    # Performers with more than one StashBox link are not supported, there is no way to chose one over another
+    summary["multiLink"] = count > 1
+    return summary
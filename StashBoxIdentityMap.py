@@ -0,0 +1,164 @@
+from datetime import datetime, timedelta
+import os
+import sqlite3
+from typing import Dict, Iterable, List, Set, Tuple
+
+from StashBoxCache import StashBoxCache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS identities (
+    source_instance TEXT,
+    source_id TEXT,
+    target_instance TEXT,
+    target_id TEXT,
+    origin TEXT,
+    updated TEXT,
+    edit_id TEXT,
+    PRIMARY KEY (source_instance, source_id, target_instance, target_id)
+);
+CREATE INDEX IF NOT EXISTS identities_target ON identities(target_instance, target_id, source_instance);
+
+CREATE TABLE IF NOT EXISTS synced_caches (
+    target_instance TEXT,
+    source_instance TEXT,
+    cache_date TEXT,
+    PRIMARY KEY (target_instance, source_instance)
+);
+"""
+
+# Number of ids per query, below the SQLite limit on query parameters
+QUERY_CHUNK = 500
+# Age after which a link edit that is no longer open is known to be rejected, accepted ones have been read from the urls by then
+EDIT_LINK_DAYS = 7
+
+class StashBoxIdentityMap:
+    """
+    Persistent map of the performers known to be the same person on different StashBox instances.
+
+    Each identity is a target performer and the source performer it links to. It comes either from the urls of the
+    target performer ("url"), or from a link edit submitted by the bot that may not be accepted yet ("edit").
+    Identities can be looked up from either side, in bulk. "edit" identities are dropped by expireEditLinks once their edit
+    was closed without being applied.
+    """
+    dbFile : str
+    connection : sqlite3.Connection = None
+
+    def __init__(self, dbFile : str = None) -> None:
+        self.dbFile = dbFile if dbFile is not None else "Cache/identity_map.sqlite"
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.dbFile) or ".", exist_ok=True)
+            self.connection = sqlite3.connect(self.dbFile)
+            self.connection.executescript(SCHEMA)
+        return self.connection
+
+    def syncFromCache(self, cache : StashBoxCache, sourceInstance : str):
+        """
+        Replaces the identities read from urls with the links to sourceInstance of the performers in cache
+
+        Skipped if the cache did not change since the last sync
+        """
+        connection = self._connect()
+        synced = connection.execute(
+            "SELECT cache_date FROM synced_caches WHERE target_instance = ? AND source_instance = ?",
+            (cache.stashBoxInstance, sourceInstance)
+        ).fetchone()
+        if synced is not None and synced[0] == cache.cacheDate.isoformat():
+            return
+
+        updated = datetime.now().isoformat()
+        rows = []
+        for targetId in cache.findPerformerIdsLinkedTo(sourceInstance):
+            for sourceId in cache.getLinkSummary(targetId)["sourceIds"][sourceInstance]:
+                rows.append((sourceInstance, sourceId, cache.stashBoxInstance, targetId, "url", updated))
+
+        connection.execute(
+            "DELETE FROM identities WHERE source_instance = ? AND target_instance = ? AND origin = 'url'",
+            (sourceInstance, cache.stashBoxInstance)
+        )
+        # Links added by the bot become "url" identities once their edit is accepted
+        connection.executemany(
+            "INSERT OR REPLACE INTO identities (source_instance, source_id, target_instance, target_id, origin, updated) VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO synced_caches (target_instance, source_instance, cache_date) VALUES (?, ?, ?)",
+            (cache.stashBoxInstance, sourceInstance, cache.cacheDate.isoformat())
+        )
+        connection.commit()
+        print(f"Identity map contains {len(rows)} links from {cache.stashBoxInstance} to {sourceInstance}")
+
+    def addLinks(self, sourceInstance : str, targetInstance : str, links : List[Tuple[str, str, str]]):
+        """
+        Records the identities of link edits submitted to targetInstance, until they are accepted or expire
+
+        ### Parameters
+            - sourceInstance (str): Instance of the linked performers
+            - targetInstance (str): Instance of the performers holding the links
+            - links ([(str, str, str)]): (source id, target id, edit id) triples
+        """
+        updated = datetime.now().isoformat()
+        connection = self._connect()
+        connection.executemany(
+            "INSERT OR IGNORE INTO identities (source_instance, source_id, target_instance, target_id, origin, updated, edit_id) VALUES (?, ?, ?, ?, 'edit', ?, ?)",
+            [(sourceInstance, sourceId, targetInstance, targetId, updated, editId) for sourceId, targetId, editId in links]
+        )
+        connection.commit()
+
+    def expireEditLinks(self, targetInstance : str, openEditIds : Iterable[str]):
+        """
+        Drops the "edit" identities of targetInstance whose edit is no longer open, once they are older than EDIT_LINK_DAYS
+
+        An accepted link is read back from the urls of the target performer, the identity left from its edit was rejected
+
+        ### Parameters
+            - targetInstance (str): Instance the link edits were submitted to
+            - openEditIds ([str]): Ids of the edits still open on targetInstance
+        """
+        openEditIds = set(openEditIds)
+        expiry = (datetime.now() - timedelta(days=EDIT_LINK_DAYS)).isoformat()
+        connection = self._connect()
+        expired = [
+            (sourceInstance, sourceId, targetId) for sourceInstance, sourceId, targetId, editId in connection.execute(
+                "SELECT source_instance, source_id, target_id, edit_id FROM identities WHERE target_instance = ? AND origin = 'edit' AND updated < ?",
+                (targetInstance, expiry))
+            if editId not in openEditIds
+        ]
+        connection.executemany(
+            "DELETE FROM identities WHERE source_instance = ? AND source_id = ? AND target_instance = ? AND target_id = ? AND origin = 'edit'",
+            [(sourceInstance, sourceId, targetInstance, targetId) for sourceInstance, sourceId, targetId in expired]
+        )
+        connection.commit()
+        if len(expired) > 0:
+            print(f"{len(expired)} link edits to {targetInstance} were not accepted, their identities are dropped")
+
+    def getLinkedIds(self, instance : str, performerIds : Iterable[str], otherInstance : str) -> Dict[str, Set[str]]:
+        """
+        Returns the performers of otherInstance known to be the same as performers of instance, whichever side holds the link
+
+        ### Parameters
+            - instance (str): Instance of performerIds
+            - performerIds ([str]): Performers to look up
+            - otherInstance (str): Instance to find their counterparts in
+
+        ### Returns
+            The ids of the counterparts on otherInstance, by id of performerIds. Performers without any are left out
+        """
+        performerIds = list(performerIds)
+        connection = self._connect()
+        linked = {}
+        for start in range(0, len(performerIds), QUERY_CHUNK):
+            chunk = performerIds[start:start + QUERY_CHUNK]
+            placeholders = ",".join(["?"] * len(chunk))
+            rows = connection.execute(
+                f"SELECT source_id, target_id FROM identities WHERE source_instance = ? AND target_instance = ? AND source_id IN ({placeholders})",
+                [instance, otherInstance] + chunk
+            ).fetchall()
+            rows += connection.execute(
+                f"SELECT target_id, source_id FROM identities WHERE target_instance = ? AND source_instance = ? AND target_id IN ({placeholders})",
+                [instance, otherInstance] + chunk
+            ).fetchall()
+            for performerId, otherId in rows:
+                linked.setdefault(performerId, set()).add(otherId)
+        return linked
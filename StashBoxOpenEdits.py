@@ -0,0 +1,175 @@
+from datetime import datetime, timedelta
+import json
+import math
+import os
+from typing import Dict, List, Set
+
+import StashBoxWrapperGQLQueries as GQLQ
+from StashBoxClient import runSync
+from StashBoxWrapper import callGraphQL, getPagesAsync, stashDateToDateTime
+
+# A full sync is done again after this long, in case an incremental sync missed a change
+FULL_SYNC_DAYS = 7
+# Statuses of the edits that are no longer open. Queries filter on a single status
+CLOSED_STATUSES = ["ACCEPTED", "REJECTED", "IMMEDIATE_ACCEPTED", "IMMEDIATE_REJECTED", "FAILED", "CANCELED"]
+
+class StashBoxOpenEditsTracker:
+    """
+    Local index of the pending performer edits of a StashBox instance.
+
+    The index is saved to a file, and synced incrementally: pending edits created since the last sync are added,
+    edits closed since the last sync are removed.
+    """
+    endpoint : Dict
+    filename : str
+    # Pending edits by id: {"operation": str, "target": str, "created": str}
+    edits : Dict[str, Dict]
+    # Operations of the pending edits of each performer, by target id
+    byTarget : Dict[str, Set[str]]
+    fullSyncDate : datetime = None
+    # Latest creation / closing dates seen during the last sync, as sent by the server
+    createdWatermark : str = None
+    closedWatermark : str = None
+
+    def __init__(self, endpoint : Dict, filename : str = None) -> None:
+        self.endpoint = endpoint
+        self.filename = filename if filename is not None else f"Cache/{endpoint['name']}_open_edits.json"
+        self.edits = {}
+        self.byTarget = {}
+
+    def sync(self):
+        """
+        Loads the saved index and brings it up to date with the server, then saves it
+        """
+        self._load()
+        if self.fullSyncDate is None or self.fullSyncDate < datetime.now() - timedelta(days=FULL_SYNC_DAYS):
+            self._fullSync()
+        else:
+            self._incrementalSync()
+        self._buildIndex()
+        self._save()
+        print(f"{len(self.edits)} open edits on {self.endpoint['name']}")
+
+    def targetsWithOpenEdits(self, operations : List[str] = ["MODIFY", "DESTROY"]) -> Set[str]:
+        """
+        Returns the ids of the performers with a pending edit using one of the operations
+        """
+        return set([targetId for targetId, targetOperations in self.byTarget.items() if not targetOperations.isdisjoint(operations)])
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, mode='r', encoding='utf-8') as file:
+            saved = json.load(file)
+        self.edits = saved["edits"]
+        self.fullSyncDate = datetime.fromisoformat(saved["fullSyncDate"])
+        self.createdWatermark = saved["createdWatermark"]
+        self.closedWatermark = saved["closedWatermark"]
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        with open(self.filename + ".tmp", mode='w', encoding='utf-8') as file:
+            json.dump({
+                "fullSyncDate": self.fullSyncDate.isoformat(),
+                "createdWatermark": self.createdWatermark,
+                "closedWatermark": self.closedWatermark,
+                "edits": self.edits
+            }, file)
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def _buildIndex(self):
+        self.byTarget = {}
+        for edit in self.edits.values():
+            if edit["target"] is not None:
+                self.byTarget.setdefault(edit["target"], set()).add(edit["operation"])
+
+    def _pendingQuery(self) -> Dict:
+        # Sorted on creation, the date every edit has. A pending edit that was updated keeps its target and operation
+        return {
+            "target_type" : "PERFORMER",
+            "status" : "PENDING",
+            "include_user_submitted" : True,
+            "sort" : "CREATED_AT",
+            "direction" : "DESC",
+            "page" : 1,
+            "per_page" : 100
+        }
+
+    def _closedQuery(self, status : str) -> Dict:
+        return {
+            "target_type" : "PERFORMER",
+            "status" : status,
+            "include_user_submitted" : True,
+            "sort" : "CLOSED_AT",
+            "direction" : "DESC",
+            "page" : 1,
+            "per_page" : 100
+        }
+
+    def _fullSync(self):
+        print("Downloading all open edits")
+        # Taken first, edits closed while downloading are removed by the next sync
+        latestClosed = []
+        for status in CLOSED_STATUSES:
+            latestClosed.extend(callGraphQL(self.endpoint, GQLQ.GET_EDITS_INDEX, {"input" : dict(self._closedQuery(status), per_page=1)}, "page")["queryEdits"]["edits"])
+
+        query = self._pendingQuery()
+        response = callGraphQL(self.endpoint, GQLQ.GET_EDITS_INDEX, {"input" : query}, "page")["queryEdits"]
+        responses = [response]
+        pages = math.ceil(response["count"] / query["per_page"])
+        if pages > 1:
+            responses.extend(runSync(getPagesAsync(self.endpoint, GQLQ.GET_EDITS_INDEX, query, "queryEdits", range(2, pages + 1))))
+
+        self.edits = {}
+        for response in responses:
+            for edit in response["edits"]:
+                self._storeEdit(edit)
+        self.createdWatermark = self._latest([edit["created"] for edit in self.edits.values()])
+        self.closedWatermark = self._latest([edit.get("closed") for edit in latestClosed])
+        self.fullSyncDate = datetime.now()
+
+    def _incrementalSync(self):
+        for edit in self._editsSince(self._pendingQuery(), "created", self.createdWatermark):
+            self._storeEdit(edit)
+            self.createdWatermark = self._latest([self.createdWatermark, edit["created"]])
+
+        closed = 0
+        closedWatermark = self.closedWatermark
+        for status in CLOSED_STATUSES:
+            for edit in self._editsSince(self._closedQuery(status), "closed", closedWatermark):
+                if self.edits.pop(edit["id"], None) is not None:
+                    closed += 1
+                self.closedWatermark = self._latest([self.closedWatermark, edit["closed"]])
+        print(f"Open edits synced, {closed} closed since the last sync")
+
+    def _editsSince(self, query : Dict, dateField : str, watermark : str) -> List[Dict]:
+        """
+        Pages the query, most recent first, until an edit with dateField at or before the watermark
+
+        Edits without dateField are skipped
+        """
+        watermarkDate = stashDateToDateTime(watermark) if watermark is not None else None
+        returnData = []
+        while True:
+            response = callGraphQL(self.endpoint, GQLQ.GET_EDITS_INDEX, {"input" : query}, "page")["queryEdits"]
+            for edit in response["edits"]:
+                if edit.get(dateField) is None:
+                    continue
+                if watermarkDate is not None and stashDateToDateTime(edit[dateField]) <= watermarkDate:
+                    return returnData
+                returnData.append(edit)
+            if query["page"] * query["per_page"] >= response["count"]:
+                return returnData
+            query["page"] += 1
+
+    def _storeEdit(self, edit : Dict):
+        self.edits[edit["id"]] = {
+            "operation": edit["operation"],
+            "target": (edit.get("target") or {}).get("id"),
+            "created": edit.get("created")
+        }
+
+    @staticmethod
+    def _latest(dates : List[str]) -> str:
+        dates = [date for date in dates if date is not None]
+        return max(dates, key=stashDateToDateTime) if len(dates) > 0 else None
@@ -5,14 +5,18 @@ import sys
 import time
 from datetime import datetime
 from enum import Enum
-from typing import List
+from typing import Dict, Iterable, List, Tuple
 
 from tabulate import tabulate
 
 import schema_types as t
 from StashBoxCache import StashBoxCache
+from StashBoxClient import DEFAULT_REQUESTS_PER_SECOND, StashBoxError, requestDeadline
 from StashBoxHelperClasses import StashSource, normalise_url
+from StashBoxIdentityMap import StashBoxIdentityMap
+from StashBoxOpenEdits import StashBoxOpenEditsTracker
 from StashBoxWrapper import (
+    BATCH_SIZE,
     ComparisonReturnCode,
     StashBoxCacheManager,
     StashBoxPerformerHistory,
@@ -20,7 +24,6 @@ from StashBoxWrapper import (
     StashBoxSitesMapper,
     comparePerformers,
     convertCountry,
-    getOpenEdits,
     stashDateToDateTime,
 )
 
@@ -69,7 +72,21 @@ def concat_urls(destination: StashSource, existing_urls: list[t.URL], new_urls:
     return future_urls
 
 
-def update_performer(source_endpoint, destination_endpoint, target_performer: t.Performer, comment: str, output_filestream=None, cache: StashBoxCache = None) -> ReturnCode:
+def get_source_id(source_endpoint, target_performer: t.Performer, target_cache: StashBoxCache = None) -> str:
+    '''
+    Returns the id of the source performer linked from target_performer
+    target_cache can be given if target_performer comes from it, to read the id from its link summary
+    '''
+    if target_cache is not None:
+        source_ids = target_cache.getLinkSummary(target_performer['id'])["sourceIds"].get(source_endpoint['name'])
+        if source_ids:
+            return source_ids[0]
+    source_url = [url for url in target_performer['urls'] if SITEMAPPER.is_link_to_instance(
+        url['url'], source_endpoint['name'])][0]['url']
+    return source_url.split('/').pop()
+
+
+def update_performer(source_endpoint, destination_endpoint, target_performer: t.Performer, comment: str, output_filestream=None, cache: StashBoxCache = None, source_history: StashBoxPerformerHistory = None, source_id: str = None) -> ReturnCode:
     '''
     Updates target_performer in destination_endpoint with the data from source_endpoint.
         target_performer must be sourced from destination_endpoint
@@ -77,20 +94,23 @@ def update_performer(source_endpoint, destination_endpoint, target_performer: t.
 
         comment is directly sent to the destination_endpoint as the Edit comment
         output_filestream allows error messages to be sent to a file, for later processing with *manual* mode
+        source_history can be given if the history of the source performer was already built
+        source_id can be given if the source performer linked from target_performer is already known
     '''
-    source_url = [url for url in target_performer['urls'] if SITEMAPPER.is_link_to_instance(
-        url['url'], source_endpoint['name'])][0]['url']
-    source_id = source_url.split('/').pop()
+    if source_id is None:
+        source_id = get_source_id(source_endpoint, target_performer)
     latest_update_date = stashDateToDateTime(target_performer["updated"])
 
-    try:
-        source_performer_history = StashBoxPerformerHistory(
-            source_endpoint, source_id, cache, SITEMAPPER)
-    except Exception:
-        print(f"{target_performer['name']} --- Error while processing --- !!!")
-        print(
-            f"{target_performer['name']},{target_performer['id']},{source_id},ERROR,False", file=output_filestream)
-        return ReturnCode.ERROR
+    source_performer_history = source_history
+    if source_performer_history is None:
+        try:
+            source_performer_history = StashBoxPerformerHistory(
+                source_endpoint, source_id, cache, SITEMAPPER)
+        except Exception:
+            print(f"{target_performer['name']} --- Error while processing --- !!!")
+            print(
+                f"{target_performer['name']},{target_performer['id']},{source_id},ERROR,False", file=output_filestream)
+            return ReturnCode.ERROR
     performer_manager = StashBoxPerformerManager(
         source_endpoint, destination_endpoint, cache=cache, sitesMapper=SITEMAPPER)
     performer_manager.setPerformer(source_performer_history.performer)
@@ -141,22 +161,26 @@ def update_performer(source_endpoint, destination_endpoint, target_performer: t.
     return ReturnCode.NO_NEED
 
 
-def manual_update_performer(source_endpoint, destination_endpoint, target_performer: t.Performer, source_id: str, comment: str, cache: StashBoxCache = None, bot=False):
+def manual_update_performer(source_endpoint, destination_endpoint, target_performer: t.Performer, source_id: str, comment: str, cache: StashBoxCache = None, bot=False, source_performer: t.Performer = None):
     '''
     ### Summary
     Force update of a Performer based on the source and sourceId, not performing any checks.
     Explicitely designed to NOT remove images unless those were removed from Source.
     Explicitely designed to ONLY ADD aliases, removals must be handled manually to avoid data loss.
+    source_performer can be given if it was already retrieved from source_endpoint, with its edits
     '''
 
     print(f"Ready to update {target_performer['name']}")
 
     source_performer_manager = StashBoxPerformerManager(
         source_endpoint, destination_endpoint, SITEMAPPER, cache=cache)
-    source_performer_manager.getPerformer(source_id)
+    if source_performer is None:
+        source_performer = source_performer_manager.getPerformer(source_id)
+    source_performer_manager.setPerformer(source_performer)
     try:
+        # Without a cache, the performer was retrieved with its edits, no need to look it up again
         source_performer_history = StashBoxPerformerHistory(
-            source_endpoint, source_id, cache, SITEMAPPER)
+            source_endpoint, source_id, cache, SITEMAPPER, source_performer)
     except Exception:
         print(f"{target_performer['name']} --- Error while retrieving SOURCE history --- !!!")
         return ReturnCode.ERROR
@@ -188,7 +212,7 @@ def manual_update_performer(source_endpoint, destination_endpoint, target_perfor
     print(f"{target_performer['name']} updated")
 
 
-def filter_performers_for_update(performer_list: List[t.Performer], source_endpoint, target_endpoint, verbose=False) -> List[t.Performer]:
+def filter_performers_for_update(performer_list: Iterable[t.Performer], source_endpoint, target_endpoint, verbose=False, target_cache: StashBoxCache = None) -> List[t.Performer]:
     '''
     Filters a list of performers to remove those that:
     - already have open Edits
@@ -196,17 +220,14 @@ def filter_performers_for_update(performer_list: List[t.Performer], source_endpo
     - have links to more than one StashBox instances (not supported, can't chose one over another)
 
     Also allows reporting of the number of performers excluded for each reason in verbose mode.
+    If the performers come from target_cache, their links are read from its link summaries instead of their urls.
     '''
 
     new_list = []
-    open_edits = getOpenEdits(target_endpoint)
-    performers_with_open_edits = list(map(
-        lambda edit: edit["target"]["id"],
-        filter(
-            lambda edit: edit["operation"] in ["MODIFY", "DESTROY"],
-            open_edits
-        )
-    ))
+    open_edits = StashBoxOpenEditsTracker(target_endpoint)
+    open_edits.sync()
+    performers_with_open_edits = open_edits.targetsWithOpenEdits(["MODIFY", "DESTROY"])
+    linked_to_source = target_cache.findPerformerIdsLinkedTo(source_endpoint['name']) if target_cache is not None else None
 
     # Variables for stats
     multi_link = 0
@@ -224,17 +245,20 @@ def filter_performers_for_update(performer_list: List[t.Performer], source_endpo
                 skip_edit += 1
                 continue
 
-            if [url for url in each_performer['urls'] if SITEMAPPER.is_link_to_instance(url['url'], source_endpoint['name'])] == []:
-                # Performer has no link to source
-                continue
+            if linked_to_source is not None:
+                if each_performer["id"] not in linked_to_source:
+                    # Performer has no link to source
+                    continue
+                multi_linked = target_cache.getLinkSummary(each_performer["id"])["multiLink"]
+            else:
+                linked_instances = [SITEMAPPER.classify(url["url"])[1] for url in each_performer["urls"]]
+                if StashSource[source_endpoint['name']] not in linked_instances:
+                    # Performer has no link to source
+                    continue
+                multi_linked = len([instance for instance in linked_instances if instance is not None]) > 1
             have_link += 1
 
-            counter = 0
-            for url in [url["url"] for url in each_performer["urls"]]:
-                if SITEMAPPER.whichStashBoxLink(url) is not None:
-                    counter += 1
-
-            if counter > 1:
+            if multi_linked:
                 # Performer has more than one StashBox link, for now this is not supported
                 multi_link += 1
                 continue
@@ -292,11 +316,34 @@ def console_confirm_performer_comparison(target_performer, source_performer):
         raise e
 
 
-def add_stashbox_link_to_performer(source_endpoint, destination_endpoint, target_performer: t.Performer, source_id: str, comment: str):
+def add_stashbox_links_to_performers(source_endpoint, destination_endpoint, links: List[Tuple[t.Performer, str]], comment: str) -> Dict[str, str]:
     '''
-    Adds a StashBox link to an existing performer
+    Adds a StashBox link to several existing performers, submitting the edits in batches
+
+    links is a list of (target_performer, source_id)
+    Returns the id of the edit submitted for each target performer, by target id. Performers whose edit failed are left out
     '''
+    performer_namager = StashBoxPerformerManager(
+        source_endpoint, destination_endpoint, SITEMAPPER)
+    drafts = {}
+    for target_performer, source_id in links:
+        drafts[target_performer["id"]] = stashbox_link_draft(source_endpoint, destination_endpoint, target_performer, source_id)
+
+    result = performer_namager.submitPerformerUpdates(drafts, comment, False)
+    edit_ids = {}
+    for target_performer, _ in links:
+        if target_performer["id"] in result.errors:
+            print(f"Error processing performer {target_performer['name']}: {result.errors[target_performer['id']]}")
+        else:
+            edit_ids[target_performer["id"]] = (result.results.get(target_performer["id"]) or {}).get("id")
+            print(f"{target_performer['name']} updated")
+    return edit_ids
 
+
+def stashbox_link_draft(source_endpoint, destination_endpoint, target_performer: t.Performer, source_id: str) -> t.PerformerEditDetailsInput:
+    '''
+    Returns the details of target_performer, with a link to source_id added
+    '''
     performer_namager = StashBoxPerformerManager(
         source_endpoint, destination_endpoint, SITEMAPPER)
     performer_namager.setPerformer(target_performer)
@@ -316,14 +363,7 @@ def add_stashbox_link_to_performer(source_endpoint, destination_endpoint, target
 
     # Call concatenateUrls, just to make sure we don't add duplicates (can cause Failed updates)
     draft["urls"] = concat_urls(destination_endpoint['name'], [], existing_urls)
-
-    try:
-        performer_namager.submitPerformerUpdate(
-            target_performer["id"], draft, comment, False)
-        print(f"{target_performer['name']} updated")
-    except Exception as e:
-        print(f"Error processing performer {target_performer['name']}")
-        raise e
+    return draft
 
 
 def configure_argparse():
@@ -347,6 +387,8 @@ def configure_argparse():
                                choices=['STASHDB', 'PMVSTASH', "FANSDB"], required=True)
     general_parser.add_argument("-ssb", "--source-stashbox", help="Source StashBox instance",
                                choices=['STASHDB', 'PMVSTASH', "FANSDB"], required=True)
+    general_parser.add_argument("-cb", "--cache-backend", help="Storage used for the local caches",
+                               choices=['file', 'sqlite'], default="file")
 
     update_parser = subparsers.add_parser(
         "update", parents=[general_parser], help="")
@@ -356,11 +398,15 @@ def configure_argparse():
         "-l", "--limit", help="Maximum number of edits allowed", type=int, default=100000)
     update_parser.add_argument(
         "-sc", "--source-cache", help="Use a local cache for Source StashBox", action="store_true")
+    update_parser.add_argument(
+        "-pd", "--performer-deadline", help="Maximum number of seconds spent on API calls for a single performer", type=float, default=None)
 
     manual_parser = subparsers.add_parser(
         "manual", parents=[general_parser], help="")
     manual_parser.add_argument("-i", "--input-file", help="Input csv file containing the performers to be updated",
                               type=argparse.FileType('r', encoding='UTF-8'))
+    manual_parser.add_argument(
+        "-pd", "--performer-deadline", help="Maximum number of seconds spent on API calls for a single performer", type=float, default=None)
 
     links_parser = subparsers.add_parser(
         "links", parents=[general_parser], help="")
@@ -394,8 +440,19 @@ def read_config_file():
             config_values[each_section] = {
                 "name": each_section,
                 "endpoint": config_parser.get(each_section, 'api_url'),
-                "api_key": config_parser.get(each_section, 'api_key')
+                "api_key": config_parser.get(each_section, 'api_key'),
+                "pool_size": config_parser.getint(each_section, 'pool_size', fallback=10),
+                "max_concurrency": config_parser.getint(each_section, 'max_concurrency', fallback=config_parser.getint(each_section, 'pool_size', fallback=10)),
+                "requests_per_second": config_parser.getfloat(each_section, 'requests_per_second', fallback=DEFAULT_REQUESTS_PER_SECOND),
+                "download_parallelism": config_parser.getint(each_section, 'download_parallelism', fallback=1),
+                "hedge_after": config_parser.getfloat(each_section, 'hedge_after', fallback=None),
+                "sites_ttl_hours": config_parser.getfloat(each_section, 'sites_ttl_hours', fallback=None),
+                "timeouts": {}
             }
+            for kind in ["page", "lookup", "image", "upload"]:
+                if config_parser.has_option(each_section, f"timeout_{kind}"):
+                    connect, read = config_parser.get(each_section, f"timeout_{kind}").split(",")
+                    config_values[each_section]["timeouts"][kind] = (float(connect), float(read))
 
     return config_values
 
@@ -414,7 +471,9 @@ if __name__ == '__main__':
     SITEMAPPER.DESTINATION = StashSource[TARGET_ENDPOINT['name']]
     SITEMAPPER.getSitesFromDestinationServer(TARGET_ENDPOINT)
 
-    target_cache_manager = StashBoxCacheManager(TARGET_ENDPOINT, True)
+    # The target cache is only used to filter and match performers, the ones edited are retrieved again in full
+    target_cache_manager = StashBoxCacheManager(TARGET_ENDPOINT, True, args.cache_backend, "listing")
+    identity_map = StashBoxIdentityMap()
 
     if sys.argv[0].lower() == "update":
         print("Update mode")
@@ -422,23 +481,54 @@ if __name__ == '__main__':
         performers_list = []
 
         print("Using local cache for TARGET (always on)")
-        target_cache_manager.loadCache(True, 12, 7)
+        # The target cache is only read once, when filtering
+        target_cache_manager.loadCache(True, 12, 7, lazy=True)
         source_cache_manager = StashBoxCacheManager(
-            SOURCE_ENDPOINT,  True) if args.source_cache else None
+            SOURCE_ENDPOINT,  True, args.cache_backend, "history") if args.source_cache else None
         if source_cache_manager is not None:
             print("Using local cache for SOURCE")
             source_cache_manager.loadCache(True, 24, 14)
 
         print("Parsing list of performers to update")
         performers_list = filter_performers_for_update(
-            target_cache_manager.cache.getCache(), SOURCE_ENDPOINT, TARGET_ENDPOINT)
+            target_cache_manager.cache.iterPerformers(), SOURCE_ENDPOINT, TARGET_ENDPOINT, target_cache=target_cache_manager.cache)
         print(f"There are {len(performers_list)} to review")
 
+        identity_map.syncFromCache(target_cache_manager.cache, SOURCE_ENDPOINT['name'])
+        linked_ids = identity_map.getLinkedIds(
+            TARGET_ENDPOINT['name'], [performer["id"] for performer in performers_list], SOURCE_ENDPOINT['name'])
+        source_ids = {}
+        for performer in performers_list:
+            linked = linked_ids.get(performer["id"], set())
+            # Several links can't be told apart, read the one in the performer urls
+            source_ids[performer["id"]] = next(iter(linked)) if len(linked) == 1 else get_source_id(SOURCE_ENDPOINT, performer, target_cache_manager.cache)
+
         # Now actually do the update
         clean_performer_list = list(reversed(performers_list))
-        for performer in clean_performer_list:
-            status = update_performer(SOURCE_ENDPOINT, TARGET_ENDPOINT, performer, args.comment,
-                                      args.output, cache=source_cache_manager.cache if source_cache_manager is not None else None)
+        source_histories = {}
+        for index, performer in enumerate(clean_performer_list):
+            if index % BATCH_SIZE == 0:
+                # The target cache only has the listing fields, retrieve the next target performers in full
+                target_performers = StashBoxPerformerManager(TARGET_ENDPOINT, None, SITEMAPPER).getPerformers(
+                    [p["id"] for p in clean_performer_list[index:index + BATCH_SIZE]], withEdits=False)
+            if source_cache_manager is None and index % BATCH_SIZE == 0:
+                # Without a cache, retrieve the next source performers and their histories in a single request.
+                # The ones that failed are looked up again on their own
+                source_histories = StashBoxPerformerHistory.loadMany(
+                    SOURCE_ENDPOINT, [source_ids[p["id"]] for p in clean_performer_list[index:index + BATCH_SIZE]], SITEMAPPER).results
+            if target_performers.results.get(performer["id"]) is None:
+                print(f"{performer['name']} not updated - {target_performers.errors.get(performer['id'], 'performer not found')}")
+                continue
+            performer = target_performers.results[performer["id"]]
+            try:
+                with requestDeadline(args.performer_deadline):
+                    status = update_performer(SOURCE_ENDPOINT, TARGET_ENDPOINT, performer, args.comment,
+                                              args.output, cache=source_cache_manager.cache if source_cache_manager is not None else None,
+                                              source_history=source_histories.get(source_ids[performer["id"]]),
+                                              source_id=source_ids[performer["id"]])
+            except StashBoxError as e:
+                print(e)
+                status = ReturnCode.ERROR
             if status == ReturnCode.SUCCESS:
                 COUNT += 1
                 print(f"{performer['name']} updated")
@@ -469,24 +559,36 @@ if __name__ == '__main__':
             sys.exit()
         updateList = csv.DictReader(args.input_file, fieldnames=[
                                     'name', 'targetId', 'sourceId', "reason", "force"])
-        openEdits = getOpenEdits(TARGET_ENDPOINT)
-        performersWithOpenEdits = list(map(
-            lambda edit: edit["target"]["id"],
-            filter(
-                lambda edit: edit["operation"] in ["MODIFY", "DESTROY"],
-                openEdits
-            )
-        ))
+        openEdits = StashBoxOpenEditsTracker(TARGET_ENDPOINT)
+        openEdits.sync()
+        performersWithOpenEdits = openEdits.targetsWithOpenEdits(["MODIFY", "DESTROY"])
+        updateList = list(updateList)
+        forced = [perf for perf in updateList if perf["targetId"] not in performersWithOpenEdits
+                  and perf["force"] is not None and perf['force'].lower() == "true"]
+        # Retrieve all target and source performers upfront, in batches
+        target_performers = StashBoxPerformerManager(TARGET_ENDPOINT, None, SITEMAPPER).getPerformers(
+            [perf['targetId'] for perf in forced])
+        source_performers = StashBoxPerformerManager(SOURCE_ENDPOINT, None, SITEMAPPER).getPerformers(
+            [perf['sourceId'] for perf in forced])
         for perf in updateList:
             if perf["targetId"] in performersWithOpenEdits:
                 print(f"Has Draft already {perf['name']}")
                 continue
             if perf["force"] is not None and perf['force'].lower() == "true":
-                performerGetter = StashBoxPerformerManager(
-                    TARGET_ENDPOINT, None, SITEMAPPER)
-                performerGetter.getPerformer(perf['targetId'])
-                manual_update_performer(SOURCE_ENDPOINT, TARGET_ENDPOINT,
-                                      performerGetter.performer, perf['sourceId'], args.comment, bot=False)
+                error = target_performers.errors.get(perf['targetId']) or source_performers.errors.get(perf['sourceId'])
+                if error is not None:
+                    print(f"{perf['name']} not updated - {error}")
+                    continue
+                if target_performers.results.get(perf['targetId']) is None or source_performers.results.get(perf['sourceId']) is None:
+                    print(f"{perf['name']} not updated - performer not found")
+                    continue
+                try:
+                    with requestDeadline(args.performer_deadline):
+                        manual_update_performer(SOURCE_ENDPOINT, TARGET_ENDPOINT,
+                                              target_performers.results[perf['targetId']], perf['sourceId'], args.comment, bot=False,
+                                              source_performer=source_performers.results[perf['sourceId']])
+                except StashBoxError as e:
+                    print(f"{perf['name']} not updated - {e}")
             else:
                 print(f"Not updating {perf['name']}")
 
@@ -494,21 +596,28 @@ if __name__ == '__main__':
 
     elif sys.argv[0].lower() == "links":
         target_cache_manager.loadCache(True, 12, 2)
-        source_cache_manager = StashBoxCacheManager(SOURCE_ENDPOINT, True)
+        source_cache_manager = StashBoxCacheManager(SOURCE_ENDPOINT, True, args.cache_backend, "listing")
         source_cache_manager.loadCache(True, 48, 7)
 
-        openEdits = getOpenEdits(TARGET_ENDPOINT)
-        performersWithOpenEdits = list(map(
-            lambda edit: edit["target"]["id"],
-            filter(
-                lambda edit: edit["operation"] in ["MODIFY", "DESTROY"],
-                openEdits
-            )
-        ))
+        openEdits = StashBoxOpenEditsTracker(TARGET_ENDPOINT)
+        openEdits.sync()
+        performersWithOpenEdits = openEdits.targetsWithOpenEdits(["MODIFY", "DESTROY"])
+        identity_map.expireEditLinks(TARGET_ENDPOINT['name'], openEdits.edits.keys())
+
+        # Links in either direction are the same person, whichever instance holds them
+        identity_map.syncFromCache(target_cache_manager.cache, SOURCE_ENDPOINT['name'])
+        identity_map.syncFromCache(source_cache_manager.cache, TARGET_ENDPOINT['name'])
+        target_performers = target_cache_manager.cache.getCache()
+        # Includes the links submitted by previous runs, even if their edit is not accepted yet
+        linkedTargets = identity_map.getLinkedIds(
+            TARGET_ENDPOINT['name'], [performer["id"] for performer in target_performers], SOURCE_ENDPOINT['name'])
 
         noLinks = []
         noStashBox = []
-        for performer in target_cache_manager.cache.getCache():
+        for performer in target_performers:
+            if performer["id"] in linkedTargets:
+                # Already linked to the source
+                continue
             if performer["id"] in performersWithOpenEdits:
                 # Don't edit performers with ongoing changes, to avoid conflicts
                 continue
@@ -516,19 +625,23 @@ if __name__ == '__main__':
                 # Performer is deleted, skip
                 continue
             if performer.get("urls"):
-                stashBoxUrls = [url for url in performer['urls']
-                                if SITEMAPPER.whichStashBoxLink(url["url"]) is not None]
-                if stashBoxUrls != []:
+                if target_cache_manager.cache.getLinkSummary(performer["id"])["instances"] != []:
                     continue
                 noStashBox.append(performer)
             else:
                 noLinks.append(performer)
 
+        noLinksIds = set([performer["id"] for performer in noLinks])
+        noStashBoxIds = set([performer["id"] for performer in noStashBox])
+
         matches = []
         partialMatches = []
 
+        source_performers = source_cache_manager.cache.getCache()
         print(
-            f"There are {len(source_cache_manager.cache.getCache())} performers in the source")
+            f"There are {len(source_performers)} performers in the source")
+        linkedSources = identity_map.getLinkedIds(
+            SOURCE_ENDPOINT['name'], [performer["id"] for performer in source_performers], TARGET_ENDPOINT['name'])
         i = 0
         start = time.time()
         print(
@@ -546,69 +659,73 @@ if __name__ == '__main__':
                                         'targetId', 'sourceId'])
 
         try:
-            for performerA in source_cache_manager.cache.getCache():
+            for performerA in source_performers:
                 if len(matches) >= args.limit:
                     break
 
                 # Display progress
                 if i % 1000 == 0:
                     print(
-                        f"Searching... {i / len(source_cache_manager.cache.getCache()):.2%} in {time.time()-start:.2f}s")
+                        f"Searching... {i / len(source_performers):.2%} in {time.time()-start:.2f}s")
 
                 # Skip X% of the DB, to save time when using a low limit and calling the function several times
-                if i*100 / len(source_cache_manager.cache.getCache()) < args.skip:
+                if i*100 / len(source_performers) < args.skip:
+                    i = i + 1
+                    continue
+
+                if performerA["id"] in linkedSources:
+                    # Already linked to a target performer, no need to look for another one
                     i = i + 1
                     continue
 
+                # for now only name matches are supported
+                namesakes = target_cache_manager.cache.findPerformersByName(performerA["name"])
                 if args.mode == "ALL" or args.mode == "NOSTASHBOX":
-                    for performerB in noStashBox:
-                        if performerB.get("name").lower() == performerA.get("name").lower():
-                            comp = comparePerformers(performerA, performerB)
-                            if comp == [ComparisonReturnCode.IDENTICAL]:
-                                print(f"Found {performerB["name"]} in noStashBox")
-                                matches.append(
-                                    (performerA.get("id"), performerB.get("id")))
-                            elif not args.exact and ComparisonReturnCode.gender not in comp:
-                                in_save_file = [record for record in previous_decisions_reader if (record["targetId"] == performerB["id"] or record["targetId"] == "*") and (record["sourceId"] == performerA["id"] or record["sourceId"]=="*")]
-                                if len(in_save_file) == 0:
-                                    if console_confirm_performer_comparison(performerB, performerA):
-                                        matches.append(
-                                            (performerA.get("id"), performerB.get("id")))
-                                    else:
-                                        decision_writer.writerow({"targetId": performerB["id"], "sourceId": performerA["id"]})
-                        else:
-                            # for now only name matches are supported
-                            continue
+                    for performerB in [perf for perf in namesakes if perf["id"] in noStashBoxIds]:
+                        comp = comparePerformers(performerA, performerB)
+                        if comp == [ComparisonReturnCode.IDENTICAL]:
+                            print(f"Found {performerB["name"]} in noStashBox")
+                            matches.append(
+                                (performerA.get("id"), performerB.get("id")))
+                        elif not args.exact and ComparisonReturnCode.gender not in comp:
+                            in_save_file = [record for record in previous_decisions_reader if (record["targetId"] == performerB["id"] or record["targetId"] == "*") and (record["sourceId"] == performerA["id"] or record["sourceId"]=="*")]
+                            if len(in_save_file) == 0:
+                                if console_confirm_performer_comparison(performerB, performerA):
+                                    matches.append(
+                                        (performerA.get("id"), performerB.get("id")))
+                                else:
+                                    decision_writer.writerow({"targetId": performerB["id"], "sourceId": performerA["id"]})
 
                 if args.mode == "ALL" or args.mode == "NOLINKS":
-                    for performerB in noLinks:
-                        if performerB.get("name").lower() == performerA.get("name").lower():
-                            comp = comparePerformers(performerA, performerB)
-                            if comp == [ComparisonReturnCode.IDENTICAL]:
-                                print(f"Found {performerB["name"]} in noLinks")
-                                matches.append(
-                                    (performerA.get("id"), performerB.get("id")))
-                            elif not args.exact and ComparisonReturnCode.gender not in comp:
-                                in_save_file = [record for record in previous_decisions_reader if (record["targetId"] == performerB["id"] or record["targetId"] == "*") and (record["sourceId"] == performerA["id"] or record["sourceId"]=="*")]
-                                if len(in_save_file) == 0:
-                                    if console_confirm_performer_comparison(performerB, performerA):
-                                        matches.append(
-                                            (performerA.get("id"), performerB.get("id")))
-                                    else:
-                                        decision_writer.writerow({"targetId": performerB["id"], "sourceId": performerA["id"]})
-                        else:
-                            # for now only name matches are supported
-                            continue
+                    for performerB in [perf for perf in namesakes if perf["id"] in noLinksIds]:
+                        comp = comparePerformers(performerA, performerB)
+                        if comp == [ComparisonReturnCode.IDENTICAL]:
+                            print(f"Found {performerB["name"]} in noLinks")
+                            matches.append(
+                                (performerA.get("id"), performerB.get("id")))
+                        elif not args.exact and ComparisonReturnCode.gender not in comp:
+                            in_save_file = [record for record in previous_decisions_reader if (record["targetId"] == performerB["id"] or record["targetId"] == "*") and (record["sourceId"] == performerA["id"] or record["sourceId"]=="*")]
+                            if len(in_save_file) == 0:
+                                if console_confirm_performer_comparison(performerB, performerA):
+                                    matches.append(
+                                        (performerA.get("id"), performerB.get("id")))
+                                else:
+                                    decision_writer.writerow({"targetId": performerB["id"], "sourceId": performerA["id"]})
                 i = i + 1
 
             if len(matches) > 0:
                 UP_COUNT = 0
                 print(f"Found {len(matches)} matches to upload")
-                if UP_COUNT < args.limit:
-                    for sourcePerf, targetPerf in matches:
-                        add_stashbox_link_to_performer(SOURCE_ENDPOINT, TARGET_ENDPOINT,
-                                            target_cache_manager.cache.getPerformerById(targetPerf), sourcePerf, args.comment)
-                        UP_COUNT = UP_COUNT + 1
+                # The edits are built from the full target performers, the cache only has the listing fields
+                matched_targets = StashBoxPerformerManager(TARGET_ENDPOINT, None, SITEMAPPER).getPerformers(
+                    [targetPerf for _, targetPerf in matches[:args.limit]], withEdits=False)
+                links = [(matched_targets.results[targetPerf], sourcePerf)
+                         for sourcePerf, targetPerf in matches[:args.limit] if matched_targets.results.get(targetPerf) is not None]
+                editIds = add_stashbox_links_to_performers(SOURCE_ENDPOINT, TARGET_ENDPOINT, links, args.comment)
+                identity_map.addLinks(SOURCE_ENDPOINT['name'], TARGET_ENDPOINT['name'],
+                                      [(sourcePerf, targetPerf["id"], editIds[targetPerf["id"]]) for targetPerf, sourcePerf in links if targetPerf["id"] in editIds])
+                UP_COUNT = len(editIds)
+                print(f"{UP_COUNT} performers updated, {len(links) - UP_COUNT} failed")
                 args.save_file.close()
                 sys.exit(0)
         except KeyboardInterrupt:
@@ -0,0 +1,192 @@
+from datetime import datetime
+import json
+import os
+import sqlite3
+from typing import Iterator, List, Set
+
+import schema_types as t
+from StashBoxCache import StashBoxCache
+from StashBoxHelperClasses import LinkSummary, link_summary
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS performers (
+    id TEXT PRIMARY KEY,
+    name_lower TEXT,
+    deleted INTEGER,
+    updated TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS performers_name_lower ON performers(name_lower);
+
+CREATE TABLE IF NOT EXISTS performer_urls (
+    performer_id TEXT,
+    url TEXT
+);
+CREATE INDEX IF NOT EXISTS performer_urls_url ON performer_urls(url);
+CREATE INDEX IF NOT EXISTS performer_urls_performer ON performer_urls(performer_id);
+
+CREATE TABLE IF NOT EXISTS performer_links (
+    performer_id TEXT,
+    instance TEXT,
+    source_id TEXT,
+    multi_link INTEGER
+);
+CREATE INDEX IF NOT EXISTS performer_links_source ON performer_links(instance, source_id);
+CREATE INDEX IF NOT EXISTS performer_links_performer ON performer_links(performer_id);
+
+CREATE TABLE IF NOT EXISTS cache_info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+class StashBoxSQLiteCache(StashBoxCache):
+    """
+    StashBoxCache stored in a SQLite database instead of memory.
+
+    Performers are indexed by id, lowercased name and urls. Their edit history is moved to the edit log, as with the file cache.
+    Their StashBox links are kept in performer_links, indexed by source performer.
+
+    Changes are written to the database straight away, saveCacheToFile commits them.
+    """
+    dbFile : str
+    connection : sqlite3.Connection = None
+
+    def __init__(self, stashBoxInstance : str, dbFile : str = None) -> None:
+        super().__init__(stashBoxInstance)
+        self.dbFile = dbFile if dbFile is not None else f"Cache/{stashBoxInstance}_performers_cache.sqlite"
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.dbFile) or ".", exist_ok=True)
+            self.connection = sqlite3.connect(self.dbFile)
+            self.connection.executescript(SCHEMA)
+        return self.connection
+
+    def loadCacheFromFile(self, lazy = False):
+        # Performers are always read on demand from the database
+        cacheDate = self._connect().execute("SELECT value FROM cache_info WHERE key = 'cacheDate'").fetchone()
+        if cacheDate is None:
+            # There is no cache yet
+            return
+
+        self.cacheDate = datetime.fromisoformat(cacheDate[0])
+        profile = self._connect().execute("SELECT value FROM cache_info WHERE key = 'profile'").fetchone()
+        self.profile = profile[0] if profile is not None else "history"
+        editWatermark = self._connect().execute("SELECT value FROM cache_info WHERE key = 'editWatermark'").fetchone()
+        self.editWatermark = editWatermark[0] if editWatermark is not None else None
+        count = self._connect().execute("SELECT COUNT(*) FROM performers").fetchone()[0]
+        print(f"Cache contains {count} entries")
+
+    def saveCacheToFile(self):
+        print(f"Saving cache to database: {self.dbFile}")
+        self._connect().execute("INSERT OR REPLACE INTO cache_info (key, value) VALUES ('cacheDate', ?)", (self.cacheDate.isoformat(),))
+        self._connect().execute("INSERT OR REPLACE INTO cache_info (key, value) VALUES ('profile', ?)", (self.profile,))
+        self._connect().execute("INSERT OR REPLACE INTO cache_info (key, value) VALUES ('editWatermark', ?)", (self.editWatermark,))
+        self._connect().commit()
+
+    def getCache(self) -> List[t.Performer]:
+        return list(self.iterPerformers())
+
+    def iterPerformers(self) -> Iterator[t.Performer]:
+        """
+        Iterates over all performers, without loading the whole table in memory
+        """
+        for row in self._connect().execute("SELECT data FROM performers ORDER BY rowid"):
+            yield json.loads(row[0])
+
+    def getPerformerById(self, performerId) -> t.Performer:
+        row = self._connect().execute("SELECT data FROM performers WHERE id = ?", (performerId,)).fetchone()
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    def getPerformerEdits(self, performerId : str) -> List[t.PerformerEdit]:
+        if self.editLog is None:
+            return []
+        return self.editLog.getPerformerEdits(performerId)
+
+    def getLinkSummary(self, performerId : str) -> LinkSummary:
+        summary = {"instances": [], "sourceIds": {}, "multiLink": False}
+        for instance, sourceId, multiLink in self._connect().execute(
+                "SELECT instance, source_id, multi_link FROM performer_links WHERE performer_id = ? ORDER BY rowid", (performerId,)):
+            if instance not in summary["instances"]:
+                summary["instances"].append(instance)
+            summary["sourceIds"].setdefault(instance, []).append(sourceId)
+            summary["multiLink"] = multiLink == 1
+        return summary
+
+    def findPerformerIdsLinkedTo(self, instance : str) -> Set[str]:
+        return set([
+            row[0] for row in
+            self._connect().execute("SELECT DISTINCT performer_id FROM performer_links WHERE instance = ?", (instance,))
+        ])
+
+    def findPerformersByName(self, name : str) -> List[t.Performer]:
+        return [
+            json.loads(row[0]) for row in
+            self._connect().execute("SELECT data FROM performers WHERE name_lower = ? ORDER BY rowid", (name.lower(),))
+        ]
+
+    def findPerformersByUrl(self, url : str) -> List[t.Performer]:
+        return [
+            json.loads(row[0]) for row in
+            self._connect().execute("SELECT p.data FROM performers p JOIN performer_urls u ON u.performer_id = p.id WHERE u.url = ?", (url,))
+        ]
+
+    def setPerformers(self, performers : List[t.Performer]):
+        connection = self._connect()
+        connection.execute("DELETE FROM performers")
+        connection.execute("DELETE FROM performer_urls")
+        connection.execute("DELETE FROM performer_links")
+        edits = []
+        for performer in performers:
+            edits.extend(performer.get("edits") or [])
+            self._writePerformer(performer)
+        self._logEdits(edits)
+
+    def addPerformer(self, performer : t.Performer):
+        self._logEdits(performer.get("edits"))
+        self._writePerformer(performer)
+
+    def replacePerformer(self, performer : t.Performer, mergedIds : List[str] = None):
+        self._logEdits(performer.get("edits"))
+        self._writePerformer(performer)
+        for mergedId in mergedIds or []:
+            self.deletePerformerById(mergedId)
+
+    def deletePerformerById(self, performerId : str):
+        connection = self._connect()
+        connection.execute("DELETE FROM performers WHERE id = ?", (performerId,))
+        connection.execute("DELETE FROM performer_urls WHERE performer_id = ?", (performerId,))
+        connection.execute("DELETE FROM performer_links WHERE performer_id = ?", (performerId,))
+
+    def _writeLinks(self, performer : t.Performer):
+        summary = link_summary([url["url"] for url in performer.get("urls") or [] if url.get("url")])
+        self.connection.execute("DELETE FROM performer_links WHERE performer_id = ?", (performer["id"],))
+        self.connection.executemany(
+            "INSERT INTO performer_links (performer_id, instance, source_id, multi_link) VALUES (?, ?, ?, ?)",
+            [(performer["id"], instance, sourceId, 1 if summary["multiLink"] else 0)
+             for instance in summary["instances"] for sourceId in summary["sourceIds"][instance]]
+        )
+
+    def _writePerformer(self, performer : t.Performer):
+        """
+        Inserts or replaces a performer, without its edit history
+        """
+        connection = self._connect()
+        record = dict(performer)
+        record.pop("edits", None)
+
+        connection.execute(
+            "INSERT OR REPLACE INTO performers (id, name_lower, deleted, updated, data) VALUES (?, ?, ?, ?, ?)",
+            (record["id"], (record.get("name") or "").lower(), 1 if record.get("deleted") else 0, record.get("updated"), json.dumps(record))
+        )
+
+        connection.execute("DELETE FROM performer_urls WHERE performer_id = ?", (record["id"],))
+        connection.executemany(
+            "INSERT INTO performer_urls (performer_id, url) VALUES (?, ?)",
+            [(record["id"], url["url"]) for url in record.get("urls") or [] if url.get("url")]
+        )
+        self._writeLinks(record)
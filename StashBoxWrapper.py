@@ -1,22 +1,29 @@
+import asyncio
 import base64
 import bisect
+import json
 import math
+import os
 import re
-import time
+import threading
+from collections import OrderedDict
 from copy import deepcopy
 from datetime import datetime, timedelta
 from enum import Enum
-from typing import Dict, List
+from typing import Any, Dict, Iterable, List, NamedTuple, Tuple
 
 import pycountry
-import requests
 from stashapi.classes import serialize_dict
 from urllib3 import encode_multipart_formdata
 
 import schema_types as t
 import StashBoxWrapperGQLQueries as GQLQ
-from StashBoxCache import StashBoxCache
-from StashBoxHelperClasses import PerformerUploadConfig, StashSource
+from StashBoxCache import NO_CACHE_DATE, StashBoxCache, StashBoxDownloadCheckpoint
+from StashBoxEditLog import StashBoxEditLog
+from StashBoxClient import (RETRY_POLICY, StashBoxError, checkResponseStatus, getAsyncClient, getAsyncDownloadClient, getClient,
+                            getDownloadClient, runSync)
+from StashBoxHelperClasses import PerformerUploadConfig, StashSource, stashbox_link, url_host_key
+from StashBoxSQLiteCache import StashBoxSQLiteCache
 
 
 class ComparisonReturnCode(Enum):
@@ -70,28 +77,94 @@ def convertCountry(name):
         ct = pycountry.countries.get(name=name)
         return ct.alpha_2
 
+# GraphQL error messages caused by a temporary server issue, rather than by the request itself
+TRANSIENT_GQL_ERRORS = ["timeout", "deadline exceeded", "context canceled", "too many", "connection"]
+# Number of aliased calls packed in a single GraphQL document
+BATCH_SIZE = 20
+
+def isTransientGQLError(errors : List[Dict]) -> bool:
+    messages = " ".join([str(error.get("message", "")) for error in errors]).lower()
+    return any(transient in messages for transient in TRANSIENT_GQL_ERRORS)
+
 def handleGQLResponse(response):
+    """
+    Returns the data of a GraphQL response
+
+    Raises a StashBoxError if the call failed, classified as retryable or not
+    """
     try:
-        if response.status_code == 200:
-            jsonData = response.json()
-            if "errors" in jsonData and jsonData["errors"] is not None:
-                print(f'Error in Stash call: {response.text}')
-                raise Exception(response.text)
-            return jsonData['data']
-        else:
-            print(f"Error in Stash call: {response.status_code}" )
-    except Exception as e:
-        print("Other error")
-        raise e
+        checkResponseStatus(response)
+    except StashBoxError as e:
+        print(f"Error in Stash call: {e}")
+        raise
 
-def getImgB64(url):
-    imageRequest = requests.get(url)
+    jsonData = response.json()
+    if "errors" in jsonData and jsonData["errors"] is not None:
+        print(f'Error in Stash call: {response.text}')
+        raise StashBoxError(response.text, retryable=isTransientGQLError(jsonData["errors"]))
+    return jsonData['data']
+
+def handleGQLBatchResponse(response) -> Tuple[Dict, Dict[str, StashBoxError]]:
+    """
+    Returns the data of a GraphQL response made of aliased calls, and the errors of each alias
+
+    Raises a StashBoxError if the whole call failed
+    """
+    try:
+        checkResponseStatus(response)
+    except StashBoxError as e:
+        print(f"Error in Stash call: {e}")
+        raise
+
+    jsonData = response.json()
+    errorsByAlias : Dict[str, List[Dict]] = {}
+    for error in jsonData.get("errors") or []:
+        if not error.get("path") or jsonData.get("data") is None:
+            # The error is not tied to a single alias
+            print(f'Error in Stash call: {response.text}')
+            raise StashBoxError(response.text, retryable=isTransientGQLError(jsonData["errors"]))
+        errorsByAlias.setdefault(error["path"][0], []).append(error)
+
+    errors = {
+        alias : StashBoxError("; ".join([str(error.get("message", "")) for error in aliasErrors]), retryable=isTransientGQLError(aliasErrors))
+        for alias, aliasErrors in errorsByAlias.items()
+    }
+    return jsonData["data"], errors
+
+def checkImageResponse(imageRequest):
+    """
+    Raises a retryable StashBoxError if the image server is overloaded, other errors are handled by imageResponseToB64
+    """
+    if imageRequest.status_code in [429, 500, 502, 503, 504]:
+        checkResponseStatus(imageRequest)
+    return imageRequest
+
+def imageResponseToB64(imageRequest):
     if imageRequest.status_code != 200:
         print("Error getting image HTTP ", imageRequest.status_code)
         return None
     
     return base64.b64encode(imageRequest.content)
 
+def getImgB64(url):
+    try:
+        imageRequest = RETRY_POLICY.run(lambda: checkImageResponse(getDownloadClient().get(url, kind="image")))
+    except StashBoxError as e:
+        print(f"Error getting image {e}")
+        return None
+    return imageResponseToB64(imageRequest)
+
+async def getImgB64Async(url):
+    async def download():
+        return checkImageResponse(await getAsyncDownloadClient().get(url, kind="image"))
+
+    try:
+        imageRequest = await RETRY_POLICY.runAsync(download)
+    except StashBoxError as e:
+        print(f"Error getting image {e}")
+        return None
+    return imageResponseToB64(imageRequest)
+
 def resolveGQLFragments(gql, fragments):
     requiredFragments = []
     for fragment in fragments.keys():
@@ -104,29 +177,169 @@ def resolveGQLFragments(gql, fragments):
             requiredFragments = requiredFragments + resolveGQLFragments(GQLQ.FRAGMENTS[fragment], filteredFragments)
     return list(set(requiredFragments))
 
+class PreparedQuery(NamedTuple):
+    # The query with all the fragments it uses
+    text : str
+    # The text, already encoded as a JSON string
+    encoded : bytes
+
+PREPARED_QUERIES : Dict[str, PreparedQuery] = {}
+
+def prepareQuery(query : str) -> PreparedQuery:
+    """
+    Resolves the fragments used by a query and checks they are all defined. The result is kept, so this only happens once per query
+    """
+    if query not in PREPARED_QUERIES:
+        resolvedQuery = query + "\n" + "\n".join(sorted(resolveGQLFragments(query, GQLQ.FRAGMENTS)))
+        definedFragments = set(re.findall(r"fragment\s+(\w+)\s+on", resolvedQuery))
+        for usedFragment in re.findall(r"\.\.\.\s*(\w+)", resolvedQuery):
+            if usedFragment != "on" and usedFragment not in definedFragments:
+                raise Exception(f"GraphQL fragment {usedFragment} is used but not defined")
+        PREPARED_QUERIES[query] = PreparedQuery(resolvedQuery, json.dumps(resolvedQuery).encode())
+    return PREPARED_QUERIES[query]
+
+# The queries used on every run are prepared straight away
+for hotQuery in [GQLQ.GET_PERFORMER, GQLQ.GET_ALL_PERFORMER_EDITS] + list(GQLQ.QUERY_PROFILES.values()):
+    prepareQuery(hotQuery)
+
+def callGraphQL(stashBoxEndpoint, query, variables={}, kind = None):
+    """
+    Sends a GraphQL query or mutation, and returns its data
+
+    ### Parameters
+        - stashBoxEndpoint (Dict): The StashBox endpoint
+        - query (str): The GraphQL document, fragments are added automatically
+        - variables (Dict, optional): The variables of the document
+        - kind (str, optional): Kind of operation, setting the timeouts ("page", "lookup", "upload"). By default "upload" for mutations, "lookup" otherwise
+    """
+    body, idempotent = buildGQLBody(query, variables)
+    if kind is None:
+        kind = "lookup" if idempotent else "upload"
+    return RETRY_POLICY.run(
+        lambda: handleGQLResponse(getClient(stashBoxEndpoint).post(data=body, headers={"Content-Type": "application/json"}, kind=kind, hedge=idempotent)),
+        idempotent
+    )
+
+async def callGraphQLAsync(stashBoxEndpoint, query, variables={}, kind = None):
+    """
+    Same as callGraphQL, through the asyncio client of the endpoint. Concurrent calls share its connection pool and rate limit
+    """
+    body, idempotent = buildGQLBody(query, variables)
+    if kind is None:
+        kind = "lookup" if idempotent else "upload"
+
+    async def send():
+        return handleGQLResponse(await getAsyncClient(stashBoxEndpoint).post(data=body, headers={"Content-Type": "application/json"}, kind=kind))
+    return await RETRY_POLICY.runAsync(send, idempotent)
 
-def callGraphQL(stashBoxEndpoint, query, variables={}):
-    resolvedQuery = query + "\n" + "\n".join(resolveGQLFragments(query, GQLQ.FRAGMENTS))
-    json_request = {'query': resolvedQuery}
+def buildGQLBody(query, variables = {}):
+    """
+    Returns the JSON body of a GraphQL call, and whether it can safely be sent twice
+    """
+    body = b'{"query":' + prepareQuery(query).encoded
     
     if variables:
         serialize_dict(variables)
-        json_request['variables'] = variables
-
-    headers = {
-		"Accept-Encoding": "gzip, deflate",
-		"Content-Type": "application/json",
-		"Accept": "application/json",
-		"Connection": "keep-alive",
-		"DNT": "1",
-        "ApiKey" : stashBoxEndpoint['api_key']
-	}
-
-    response = requests.post(stashBoxEndpoint['endpoint'], json=json_request, headers=headers)
-    
-    return handleGQLResponse(response)
+        body += b',"variables":' + json.dumps(variables).encode()
+    body += b'}'
+
+    # Mutations are only sent again if the server never processed them
+    idempotent = not prepareQuery(query).text.lstrip().startswith("mutation")
+    return body, idempotent
+
+class BatchResult(NamedTuple):
+    # Result of each call that succeeded, by key. None if the server returned null
+    results : Dict[str, Any]
+    # Error of each call that failed, by key
+    errors : Dict[str, StashBoxError]
+
+def buildAliasedDocument(operation : str, field : str, argument : str, argumentType : str, selection : str, count : int) -> str:
+    """
+    Returns a GraphQL document calling field count times, each call with its own alias and input variable
+
+    ### Parameters
+        - operation (str): "query" or "mutation"
+        - field (str): The field called, e.g. findPerformer
+        - argument (str): Name of the argument of the field, e.g. id
+        - argumentType (str): GraphQL type of the argument, e.g. ID!
+        - selection (str): The fields selected from each result
+        - count (int): Number of calls
+    """
+    variables = ", ".join([f"$input{i}: {argumentType}" for i in range(count)])
+    calls = "\n".join([f"    a{i}: {field}({argument}: $input{i}) {{\n        {selection}\n    }}" for i in range(count)])
+    return f"{operation} Batch{field[0].upper()}{field[1:]}({variables}) {{\n{calls}\n}}\n"
+
+def callGraphQLAliased(stashBoxEndpoint : Dict, operation : str, field : str, argument : str, argumentType : str, selection : str, inputs : Dict[str, Any], batchSize : int = BATCH_SIZE) -> BatchResult:
+    return runSync(callGraphQLAliasedAsync(stashBoxEndpoint, operation, field, argument, argumentType, selection, inputs, batchSize))
+
+async def callGraphQLAliasedAsync(stashBoxEndpoint : Dict, operation : str, field : str, argument : str, argumentType : str, selection : str, inputs : Dict[str, Any], batchSize : int = BATCH_SIZE) -> BatchResult:
+    """
+    Sends one call of field per input, packing up to batchSize calls in each GraphQL document
+
+    A failed call doesn't fail the others of its document. Queries failing with a temporary error are sent once more
+
+    ### Parameters
+        - stashBoxEndpoint (Dict): The StashBox endpoint
+        - operation, field, argument, argumentType, selection: see buildAliasedDocument
+        - inputs (Dict[str, Any]): The argument of each call, by key
+        - batchSize (int): Maximum number of calls in a document
+
+    ### Returns
+        A BatchResult, with the same keys as inputs
+    """
+    result = BatchResult({}, {})
+
+    async def sendBatch(keys : List[str]):
+        query = buildAliasedDocument(operation, field, argument, argumentType, selection, len(keys))
+        body, idempotent = buildGQLBody(query, {f"input{i}" : inputs[key] for i, key in enumerate(keys)})
+
+        async def send():
+            return handleGQLBatchResponse(await getAsyncClient(stashBoxEndpoint).post(data=body, headers={"Content-Type": "application/json"}, kind="lookup" if idempotent else "upload"))
+        try:
+            data, errors = await RETRY_POLICY.runAsync(send, idempotent)
+        except StashBoxError as e:
+            errors = {f"a{i}" : e for i in range(len(keys))}
+            data = {}
+        for i, key in enumerate(keys):
+            if f"a{i}" in errors:
+                result.errors[key] = errors[f"a{i}"]
+            else:
+                result.errors.pop(key, None)
+                result.results[key] = data.get(f"a{i}")
+
+    async def sendAll(keys : List[str]):
+        await asyncio.gather(*[sendBatch(keys[i:i + batchSize]) for i in range(0, len(keys), batchSize)])
+
+    await sendAll(list(inputs.keys()))
+    if operation == "query":
+        retryKeys = [key for key, error in result.errors.items() if error.retryable]
+        if len(retryKeys) > 0:
+            print(f"{len(retryKeys)} {field} calls failed, trying them again")
+            await sendAll(retryKeys)
+    return result
+
+def findPerformers(stashBoxEndpoint : Dict, performerIds : List[str], batchSize : int = BATCH_SIZE, withEdits : bool = True) -> BatchResult:
+    """
+    Retrieves several performers, batchSize performers per request
+
+    ### Parameters
+        - withEdits (bool): Also retrieve their edits
+
+    ### Returns
+        A BatchResult by performer ID. The result is None for a performer that doesn't exist
+    """
+    return runSync(findPerformersAsync(stashBoxEndpoint, performerIds, batchSize, withEdits))
+
+async def findPerformersAsync(stashBoxEndpoint : Dict, performerIds : List[str], batchSize : int = BATCH_SIZE, withEdits : bool = True) -> BatchResult:
+    return await callGraphQLAliasedAsync(
+        stashBoxEndpoint, "query", "findPerformer", "id", "ID!", "... PerformerFragmentWidthEdits" if withEdits else "... PerformerFragment",
+        {performerId : performerId for performerId in performerIds}, batchSize
+    )
 
 def upload_image(destinationEndpoint, image_in, existing = {}, excluded = {}):
+    return runSync(upload_image_async(destinationEndpoint, image_in, existing, excluded))
+
+async def upload_image_async(destinationEndpoint, image_in, existing = {}, excluded = {}):
     b64img_bytes = None
     if re.search(r';base64',image_in):
         m = re.search(r'data:(?P<mime>.+?);base64,(?P<img_data>.+)',image_in)
@@ -136,7 +349,7 @@ def upload_image(destinationEndpoint, image_in, existing = {}, excluded = {}):
             # could not determine MIME type defaulting to jpeg
             mime = 'image/jpeg'
     if re.match(r'^http', image_in):
-        b64img_bytes = getImgB64(image_in)
+        b64img_bytes = await getImgB64Async(image_in)
         mime = 'image/jpeg'
 
     if b64img_bytes is None:
@@ -157,17 +370,9 @@ def upload_image(destinationEndpoint, image_in, existing = {}, excluded = {}):
         '1': ('1.jpg', base64.decodebytes(b64img_bytes), mime)
     })
 
-    request_headers = {
-		"Accept-Encoding": "gzip, deflate",
-		"Content-Type": multipart_header,
-		"Accept": "application/json",
-		"Connection": "keep-alive",
-		"DNT": "1",
-        "ApiKey" : destinationEndpoint['api_key']
-	}
-    
-    response = requests.post(destinationEndpoint['endpoint'], data=body, headers=request_headers, timeout=30)
-    return handleGQLResponse(response)["imageCreate"]
+    async def send():
+        return handleGQLResponse(await getAsyncClient(destinationEndpoint).post(data=body, headers={"Content-Type": multipart_header}, kind="upload"))
+    return (await RETRY_POLICY.runAsync(send, False))["imageCreate"]
 
 def stashDateToDateTime(stashDate : str) -> datetime:
     try:
@@ -178,97 +383,369 @@ def stashDateToDateTime(stashDate : str) -> datetime:
         raise
     return ret
 
-def getAllPerformers(sourceEndpoint : Dict, callback = None):
-    returnData = []
-    pages = -1
+def firstPerformerId(page : Dict) -> str:
+    return page["performers"][0]["id"] if len(page["performers"]) > 0 else None
+
+def isUnmovedPage(page : Dict, savedFirstId : str) -> bool:
+    """
+    Returns True if a page downloaded again still starts with the same performer as the saved one
+
+    Performers are sorted by creation date, new performers are added at the end. A page only starts with another
+    performer if performers before it were deleted, if it did not move the pages before it did not either.
+    Counts can't tell, creations at the end make up for deletions
+    """
+    firstId = firstPerformerId(page)
+    return firstId is not None and firstId == savedFirstId
+
+def getAllPerformers(sourceEndpoint : Dict, callback = None, checkpoint : StashBoxDownloadCheckpoint = None, parallelism : int = None, profile : str = "history"):
+    """
+    Downloads all performers from the endpoint, page by page, oldest performers first
+
+    ### Parameters
+        - sourceEndpoint (Dict): The StashBox endpoint
+        - callback (function, optional): Called with the list of performers of each page, as they are received
+        - checkpoint (StashBoxDownloadCheckpoint, optional): Pages are saved to it as they are received. Pages already in it are not downloaded again
+        - parallelism (int, optional): Number of pages downloaded at once (default: the endpoint's download_parallelism, or 1)
+        - profile (str): Query profile, see GQLQ.QUERY_PROFILES. Cheaper profiles download fewer fields
+
+    ### Returns
+        The list of all performers, without duplicates
+    """
+    if parallelism is None:
+        parallelism = sourceEndpoint.get("download_parallelism", 1)
+    if parallelism > 1:
+        return runSync(getAllPerformersAsync(sourceEndpoint, callback, checkpoint, parallelism, profile=profile))
+
+    pages = checkpoint.loadPages() if checkpoint is not None else {}
     query = {
         "page" : 1,
-        "per_page" : 100
+        "per_page" : 100,
+        # Sorting by creation date keeps pages stable while resuming, new performers are added at the end
+        "sort" : "CREATED_AT",
+        "direction" : "ASC"
     }
 
-    response = callGraphQL(sourceEndpoint, GQLQ.GET_ALL_PERFORMERS, {"input" : query})["queryPerformers"]
-    returnData = response["performers"]
-    pages = math.ceil(response["count"] / query["per_page"])
-    while query["page"] < pages:
+    def getPage():
+        return callGraphQL(sourceEndpoint, GQLQ.QUERY_PROFILES[profile], {"input" : query}, "page")["queryPerformers"]
+
+    def storePage(response):
+        pages[query["page"]] = {"count" : response["count"], "performers" : response["performers"]}
+        if checkpoint is not None:
+            checkpoint.savePage(query["page"], response["count"], response["performers"])
+        if callback is not None:
+            callback(response["performers"])
+
+    # Pages downloaded while looking for the resume point, by page number
+    searched = {}
+    if len(pages) > 0:
+        # Deletions shift the performers after them to earlier pages, resume from the last page that did not move.
+        # The pages before an unmoved page did not move either, binary search it
+        savedFirstIds = {page: firstPerformerId(saved) for page, saved in pages.items()}
+        low, high = 1, max(pages.keys())
+        while low < high:
+            query["page"] = (low + high + 1) // 2
+            searched[query["page"]] = getPage()
+            if isUnmovedPage(searched[query["page"]], savedFirstIds.get(query["page"])):
+                low = query["page"]
+            else:
+                high = query["page"] - 1
+        query["page"] = low
+        print(f"GetAllPerformers resuming after page {query['page']}")
+    response = searched.pop(query["page"]) if query["page"] in searched else getPage()
+    storePage(response)
+
+    pageCount = math.ceil(response["count"] / query["per_page"])
+    while query["page"] < pageCount:
         query["page"] += 1
-        print(f"GetAllPerformers page {query['page']} of {pages}")
+        print(f"GetAllPerformers page {query['page']} of {pageCount}")
+        # The moved pages downloaded by the search are still current
+        response = searched.pop(query["page"]) if query["page"] in searched else getPage()
+        storePage(response)
+        pageCount = math.ceil(response["count"] / query["per_page"])
 
-        # Avoid overloading the server
-        time.sleep(10)
-        try: 
-            response = callGraphQL(sourceEndpoint, GQLQ.GET_ALL_PERFORMERS, {"input" : query})["queryPerformers"]
-            returnData.extend(response["performers"])
-            if callback is not None:
-                callback(response["performers"])
-        except TimeoutError:
-            # Wait a while and try again
-            time.sleep(60)
-            print(f"GetAllPerformers page {query['page']} of {pages} -- Retrying")
-            response = callGraphQL(sourceEndpoint, GQLQ.GET_ALL_PERFORMERS, {"input" : query})["queryPerformers"]
-            returnData.extend(response["performers"])
+    return performersFromPages(pages)
+
+async def getAllPerformersAsync(sourceEndpoint : Dict, callback = None, checkpoint : StashBoxDownloadCheckpoint = None, parallelism : int = 4, maxRounds : int = 3, profile : str = "history"):
+    """
+    Same as getAllPerformers, downloading up to parallelism pages at once
+
+    Pages are saved to the checkpoint and passed to the callback in page order, so an interrupted download resumes correctly.
+    Pages that failed are downloaded again once the others are done, up to maxRounds times.
+    If the performer count drops while downloading, performers moved to earlier pages, the pages received before the drop are downloaded again.
+
+    ### Parameters
+        - sourceEndpoint (Dict): The StashBox endpoint
+        - callback (function, optional): Called with the list of performers of each page, in page order
+        - checkpoint (StashBoxDownloadCheckpoint, optional): Pages are saved to it in page order. Pages already in it are not downloaded again
+        - parallelism (int): Number of pages downloaded at once
+        - maxRounds (int): Number of times failed pages, or pages affected by deletions, are downloaded again
+        - profile (str): Query profile, see GQLQ.QUERY_PROFILES
+
+    ### Returns
+        The list of all performers, without duplicates
+    """
+    pages = checkpoint.loadPages() if checkpoint is not None else {}
+    query = {
+        "per_page" : 100,
+        "sort" : "CREATED_AT",
+        "direction" : "ASC"
+    }
+    limit = asyncio.Semaphore(parallelism)
+    # Pages to save in this run, in the order they are saved
+    order : List[int] = []
+    # Downloaded pages waiting for the previous ones before being saved
+    received : Dict[int, Dict] = {}
+    # Performer counts, in the order the pages were received, and when each page was received
+    counts : List[int] = []
+    receivedAt : Dict[int, int] = {}
+    saved = 0
+
+    def savePages():
+        nonlocal saved
+        while saved < len(order) and order[saved] in received:
+            page = order[saved]
+            response = received.pop(page)
+            pages[page] = {"count" : response["count"], "performers" : response["performers"]}
+            if checkpoint is not None:
+                checkpoint.savePage(page, response["count"], response["performers"])
             if callback is not None:
                 callback(response["performers"])
-    
-    return returnData
+            saved += 1
+
+    async def getPage(page):
+        try:
+            async with limit:
+                response = (await callGraphQLAsync(sourceEndpoint, GQLQ.QUERY_PROFILES[profile], {"input" : dict(query, page=page)}, "page"))["queryPerformers"]
+        except StashBoxError as e:
+            print(f"GetAllPerformers page {page} failed: {e}")
+            return False
+        receivedAt[page] = len(counts)
+        counts.append(response["count"])
+        received[page] = response
+        savePages()
+        return True
+
+    async def fetch(pageNumbers : List[int]):
+        for _ in range(maxRounds):
+            print(f"GetAllPerformers downloading {len(pageNumbers)} pages, {parallelism} at once")
+            results = await asyncio.gather(*[getPage(page) for page in pageNumbers])
+            pageNumbers = [page for page, success in zip(pageNumbers, results) if not success]
+            if len(pageNumbers) == 0:
+                return
+        raise StashBoxError(f"GetAllPerformers pages {pageNumbers} could not be downloaded")
+
+    async def download(pageNumbers : List[int]):
+        # Pages already received, while looking for the resume point, are not downloaded again
+        missing = [page for page in pageNumbers if page not in received]
+        order.extend(pageNumbers)
+        savePages()
+        if len(missing) > 0:
+            await fetch(missing)
+
+    downloaded = 1
+    if len(pages) > 0:
+        # Deletions shift the performers after them to earlier pages, resume from the last page that did not move.
+        # The pages before an unmoved page did not move either, search it parallelism pages at a time
+        savedFirstIds = {page: firstPerformerId(saved) for page, saved in pages.items()}
+        low, high = 1, max(pages.keys())
+        while low < high:
+            probes = sorted(set([low + math.ceil((high - low) * (index + 1) / (parallelism + 1)) for index in range(parallelism)]))
+            await fetch(probes)
+            for page in probes:
+                if isUnmovedPage(received[page], savedFirstIds.get(page)):
+                    low = max(low, page)
+                else:
+                    high = min(high, page - 1)
+        # Pages before the resume point are unchanged, the moved ones after it are kept
+        for page in [page for page in received if page < low]:
+            received.pop(page)
+        downloaded = low
+        print(f"GetAllPerformers resuming after page {downloaded}")
+    await download([downloaded])
+
+    checked = 0
+    for _ in range(maxRounds + 1):
+        # Performers created while downloading add pages at the end
+        pageCount = math.ceil(counts[-1] / query["per_page"])
+        while downloaded < pageCount:
+            await download(list(range(downloaded + 1, pageCount + 1)))
+            downloaded = pageCount
+            pageCount = math.ceil(counts[-1] / query["per_page"])
+
+        # A drop in the count means performers were deleted, the ones after them moved to earlier pages
+        drops = [index for index in range(max(checked, 1), len(counts)) if counts[index] < counts[index - 1]]
+        checked = len(counts)
+        if len(drops) == 0:
+            break
+        stalePages = sorted([page for page, index in receivedAt.items() if index < drops[-1] and page <= pageCount])
+        print(f"GetAllPerformers performer count dropped while downloading, downloading {len(stalePages)} pages again")
+        await download(stalePages)
+
+    return performersFromPages(pages)
 
-def getAllEdits(endpoint : Dict, limit = 7, callback = None):
-    dateLimit = datetime.now() - timedelta(days=limit)
+def getPerformersUpdatedSince(sourceEndpoint : Dict, since : datetime, profile : str = "history") -> List[t.Performer]:
+    """
+    Downloads the performers updated since a date, most recently updated first, and stops at the first older one
 
-    returnData = []
-    pages = -1
+    Performers updated while paging move to the first page, shifting the others back: some are received twice, none are skipped.
+    Their latest change is picked up by the next refresh
+
+    ### Parameters
+        - sourceEndpoint (Dict): The StashBox endpoint
+        - since (datetime): Oldest update date to download
+        - profile (str): Query profile, see GQLQ.QUERY_PROFILES
+
+    ### Returns
+        The list of updated performers, without duplicates
+    """
+    query = {
+        "page" : 1,
+        "per_page" : 100,
+        "sort" : "UPDATED_AT",
+        "direction" : "DESC"
+    }
+
+    returnData = {}
+    while True:
+        print(f"GetPerformersUpdatedSince page {query['page']}")
+        response = callGraphQL(sourceEndpoint, GQLQ.QUERY_PROFILES[profile], {"input" : query}, "page")["queryPerformers"]
+        for performer in response["performers"]:
+            if stashDateToDateTime(performer["updated"]) < since:
+                return list(returnData.values())
+            # Keep the first copy received, it is the most recent one
+            returnData.setdefault(performer["id"], performer)
+        if query["page"] * query["per_page"] >= response["count"]:
+            return list(returnData.values())
+        query["page"] += 1
+
+def getEditsSince(endpoint : Dict, since : datetime = None, operation : str = None, watermark : str = None, callback = None, parallelism : int = None, knownIds : Iterable[str] = None) -> List[t.PerformerEdit]:
+    return runSync(getEditsSinceAsync(endpoint, since, operation, watermark, callback, parallelism, knownIds))
+
+async def getEditsSinceAsync(endpoint : Dict, since : datetime = None, operation : str = None, watermark : str = None, callback = None, parallelism : int = None, knownIds : Iterable[str] = None) -> List[t.PerformerEdit]:
+    """
+    Downloads the applied performer edits closed since a date, most recently closed first
+
+    Edits closed while paging shift the others to later pages, the copies received twice are dropped
+
+    ### Parameters
+        - endpoint (Dict): The StashBox endpoint
+        - since (datetime, optional): Oldest closing date to download
+        - operation (str, optional): Only download the edits with this operation (CREATE, MODIFY, DESTROY, MERGE)
+        - watermark (str, optional): Closing date of the latest edit already known, only the edits closed at or after it are downloaded.
+        Several edits can close in the same second, the ones closed at the watermark are only dropped if they are in knownIds
+        - callback (function, optional): Called with the list of new edits of each page, in page order
+        - parallelism (int, optional): Number of pages downloaded at once after the first one (default: the endpoint's download_parallelism, or 1).
+        Pages past the last new edit may be downloaded for nothing
+        - knownIds (Iterable[str], optional): Ids of the edits already known, dropped instead of returned
+    """
+    if parallelism is None:
+        parallelism = endpoint.get("download_parallelism", 1)
     query = {
         "applied": True,
         "target_type" : "PERFORMER",
+        "sort" : "CLOSED_AT",
+        "direction" : "DESC",
         "page" : 1,
         "per_page" : 100
     }
+    if operation is not None:
+        query["operation"] = operation
+
+    watermarkDate = stashDateToDateTime(watermark) if watermark is not None else None
+    knownIds = set(knownIds) if knownIds is not None else set()
+
+    def isPast(edit):
+        closed = stashDateToDateTime(edit["closed"])
+        return (since is not None and closed < since) or (watermarkDate is not None and closed < watermarkDate)
+
+    print(f"GetEditsSince {operation or ''} page 1")
+    responses = [(await callGraphQLAsync(endpoint, GQLQ.GET_ALL_PERFORMER_EDITS, {"input" : query}, "page"))["queryEdits"]]
+    pages = math.ceil(responses[0]["count"] / query["per_page"])
+    lastPage = 1
+    returnData = {}
+    while True:
+        for response in responses:
+            newEdits = []
+            done = False
+            for edit in response["edits"]:
+                if isPast(edit):
+                    done = True
+                    break
+                if edit["id"] not in returnData and edit["id"] not in knownIds:
+                    returnData[edit["id"]] = edit
+                    newEdits.append(edit)
+            if callback is not None and len(newEdits) > 0:
+                callback(newEdits)
+            if done:
+                return list(returnData.values())
+        if lastPage >= pages:
+            return list(returnData.values())
+        nextPages = list(range(lastPage + 1, min(lastPage + parallelism, pages) + 1))
+        if len(nextPages) == 1:
+            print(f"GetEditsSince {operation or ''} page {nextPages[0]}")
+        else:
+            print(f"GetEditsSince {operation or ''} pages {nextPages[0]} to {nextPages[-1]}")
+        responses = await getPagesAsync(endpoint, GQLQ.GET_ALL_PERFORMER_EDITS, query, "queryEdits", nextPages)
+        lastPage = nextPages[-1]
 
-    print("GetAllEdits page 1")
-    response = callGraphQL(endpoint, GQLQ.GET_ALL_PERFORMER_EDITS, {"input" : query})["queryEdits"]
-    returnData = response["edits"]
-    pages = math.ceil(response["count"] / query["per_page"])
-    while query["page"] < pages:
-        query["page"] += 1
-        print(f"GetAllEdits page {query['page']} of {pages}")
+def performersFromPages(pages : Dict[int, Dict]) -> List[t.Performer]:
+    """
+    Returns the performers of downloaded pages, in page order, without duplicates
+    """
+    returnData = {}
+    for page in sorted(pages.keys()):
+        for performer in pages[page]["performers"]:
+            returnData[performer["id"]] = performer
+    return list(returnData.values())
 
-        # Avoid overloading the server
-        time.sleep(5)
-        response = callGraphQL(endpoint, GQLQ.GET_ALL_PERFORMER_EDITS, {"input" : query})["queryEdits"]
-        returnData.extend(response["edits"])
-        if callback is not None:
-            callback(response["edits"])
+def getAllEdits(endpoint : Dict, limit = 7, callback = None, watermark : str = None, knownIds : Iterable[str] = None):
+    return runSync(getAllEditsAsync(endpoint, limit, callback, watermark, knownIds))
 
-        if stashDateToDateTime(response["edits"][-1]["closed"]) < dateLimit:
-            print(f"All edits for past {limit} days loaded, GetAllEdits done")
-            break
-    
-    return returnData
+async def getAllEditsAsync(endpoint : Dict, limit = 7, callback = None, watermark : str = None, knownIds : Iterable[str] = None):
+    """
+    Downloads the applied performer edits of the last limit days, most recently closed first
+
+    ### Parameters
+        - endpoint (Dict): The StashBox endpoint
+        - limit (int): Number of days to download
+        - callback (function, optional): Called with the list of edits of each page, in page order
+        - watermark (str, optional): Closing date of the latest edit already known, paging stops past it
+        - knownIds (Iterable[str], optional): Ids of the edits already known, dropped instead of returned
+    """
+    return await getEditsSinceAsync(endpoint, datetime.now() - timedelta(days=limit), watermark=watermark, callback=callback, knownIds=knownIds)
 
-def getOpenEdits(endpoint : Dict):
-    returnData = []
-    pages = -1
+def getLatestEditClosed(endpoint : Dict) -> str:
+    """
+    Returns the closing date of the latest applied performer edit, as sent by the server. None if there is no edit
+    """
     query = {
+        "applied": True,
         "target_type" : "PERFORMER",
-        "status" : "PENDING",
+        "sort" : "CLOSED_AT",
+        "direction" : "DESC",
         "page" : 1,
-        "include_user_submitted" : True,
-        "per_page" : 100
+        "per_page" : 1
     }
+    edits = callGraphQL(endpoint, GQLQ.GET_ALL_PERFORMER_EDITS, {"input" : query}, "page")["queryEdits"]["edits"]
+    return edits[0]["closed"] if len(edits) > 0 else None
 
-    print("GetOpenEdits page 1")
-    response = callGraphQL(endpoint, GQLQ.GET_ALL_PERFORMER_EDITS, {"input" : query})["queryEdits"]
-    returnData = response["edits"]
-    pages = math.ceil(response["count"] / query["per_page"])
-    while query["page"] < pages:
-        query["page"] += 1
-        print(f"GetOpenEdits page {query['page']} of {pages}")
+async def getPagesAsync(endpoint : Dict, query : str, variables : Dict, resultKey : str, pages : List[int]) -> List[Dict]:
+    """
+    Downloads several pages of a paginated query concurrently
 
-        # Avoid overloading the server
-        time.sleep(5)
-        response = callGraphQL(endpoint, GQLQ.GET_ALL_PERFORMER_EDITS, {"input" : query})["queryEdits"]
-        returnData.extend(response["edits"])
-    
-    return returnData
+    ### Parameters
+        - endpoint (Dict): The StashBox endpoint
+        - query (str): The GraphQL query, taking an "input" variable with a "page" field
+        - variables (Dict): The input of the query, its page is replaced by each requested page
+        - resultKey (str): Name of the query result in the response data
+        - pages ([int]): Numbers of the pages to download
+
+    ### Returns
+        The results, in the same order as pages
+    """
+    async def getPage(page):
+        return (await callGraphQLAsync(endpoint, query, {"input" : dict(variables, page=page)}, "page"))[resultKey]
+    return list(await asyncio.gather(*[getPage(page) for page in pages]))
 
 def comparePerformers(performerA : t.Performer, performerB : t.Performer):
     returnCodes = []
@@ -333,43 +810,119 @@ def comparePerformers(performerA : t.Performer, performerB : t.Performer):
         returnCodes = [ComparisonReturnCode.IDENTICAL]
     return returnCodes
 
+# Number of urls whose classification is remembered by each StashBoxSitesMapper
+URL_MEMO_SIZE = 100000
+# Age after which the sites saved for an instance are downloaded again, in the background
+SITES_CACHE_TTL = timedelta(hours=24)
+
 class StashBoxSitesMapper:
-    SITES_MAP = []
+    # Performer sites of the destination instance
+    SITES_MAP : List[Dict]
+    # Defaults, each mapper works on its own copy
     SOURCE_INFOS = {
         StashSource.PMVSTASH : {
             "url" : "https://pmvstash.org/",
             "siteIds" : {},
-            "regex" : r"^https?:\/\/pmvstash\.org\/performers\/.+",
             "default_performer_link" : "1cda874a-bab4-44d8-b32b-c1e485e66b6f"
         },
         StashSource.STASHDB: {
             "url" : "https://stashdb.org/",
             "siteIds" : {},
-            "regex" : r"^https:\/\/stashdb\.org\/performers\/[a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12}",
             "default_performer_link" : None
         },
         StashSource.FANSDB : {
             "url" : "https://fansdb.cc/",
             "siteIds" : {},
-            "regex" : r"^https?:\/\/(?:www\.)?fansdb\.(?:cc|xyz)\/performers\/.+",
             "default_performer_link" : None
         }
     }
     SOURCE : StashSource
     DESTINATION : StashSource
+    # Compiled site regexes, in SITES_MAP order: (by host key of the site url, all sites), as [(index, site id, pattern)]
+    _compiledSites : Tuple[Dict[str, List[Tuple[int, str, re.Pattern]]], List[Tuple[int, str, re.Pattern]]]
+    # url -> (site id, StashSource), least recently used first
+    _memo : OrderedDict
 
     def __init__(self, source : StashSource = None, destination: StashSource = None) -> None:
         self.SOURCE = source
         self.DESTINATION = destination
+        self.SITES_MAP = []
+        self.SOURCE_INFOS = deepcopy(StashBoxSitesMapper.SOURCE_INFOS)
+        self._compiledSites = ({}, [])
+        self._memo = OrderedDict()
+        self._memoLock = threading.Lock()
+
+    def _setSites(self, siteList : List[Dict]):
+        """
+        Replaces the sites with the performer sites of siteList, and compiles their regexes grouped by the hostname of the site url
+        """
+        sitesMap = [site for site in siteList if 'PERFORMER' in site['valid_types']]
+        sitesByHost = {}
+        allSites = []
+        siteIds = {}
+        for index, site in enumerate(sitesMap):
+            entry = (index, site['id'], re.compile(site['regex']))
+            allSites.append(entry)
+            sitesByHost.setdefault(url_host_key(site.get('url') or ""), []).append(entry)
+            for source in self.SOURCE_INFOS.keys():
+                if site['url'].startswith(self.SOURCE_INFOS[source]['url']):
+                    siteIds[source] = site["id"]
+
+        with self._memoLock:
+            self.SITES_MAP = sitesMap
+            if self.DESTINATION is not None:
+                self.SOURCE_INFOS[self.DESTINATION]['siteIds'] = siteIds
+            self._compiledSites = (sitesByHost, allSites)
+            self._memo.clear()
+
+    def _classifyUncached(self, url : str, host : str, compiledSites) -> Tuple[str, StashSource]:
+        sitesByHost, allSites = compiledSites
+        siteId = None
+        candidates = sitesByHost.get(host, [])
+        for _, candidateId, pattern in candidates:
+            if pattern.match(url):
+                siteId = candidateId
+                break
+        else:
+            # Some site regexes accept urls on other hosts than the site url (mirrors, renamed domains)
+            checked = set([index for index, _, _ in candidates])
+            for index, candidateId, pattern in allSites:
+                if index not in checked and pattern.match(url):
+                    siteId = candidateId
+                    break
+
+        return (siteId, stashbox_link(url)[0])
+
+    def classify(self, url : str) -> Tuple[str, StashSource]:
+        """
+        Classifies a url against the destination sites and the StashBox instances
+
+        ### Returns
+            (site id, StashSource): The id of the site matching the url, and the StashBox instance the url is a performer link to.
+            Either is None if nothing matches. The sites on the host of the url are tried first, then the others, each in SITES_MAP order
+        """
+        if not url:
+            return (None, None)
+
+        with self._memoLock:
+            result = self._memo.get(url)
+            if result is not None:
+                self._memo.move_to_end(url)
+                return result
+            compiledSites = self._compiledSites
+
+        result = self._classifyUncached(url, url_host_key(url), compiledSites)
+        with self._memoLock:
+            if compiledSites is not self._compiledSites:
+                # The sites were refreshed meanwhile, don't remember a result from the old ones
+                return result
+            self._memo[url] = result
+            if len(self._memo) > URL_MEMO_SIZE:
+                self._memo.popitem(last=False)
+        return result
 
     def mapUrlToID(self, url):
-        if url == "":
-            return None
-        
-        for site in self.SITES_MAP:
-            if re.match(site['regex'], url):
-                return site['id']
-        return None
+        return self.classify(url)[0]
 
     def mapUrlToEdit(self, url) -> Dict:
         destinationId = self.mapUrlToID(url["url"])
@@ -390,41 +943,65 @@ class StashBoxSitesMapper:
         # Temp fix, while I migrate everything to use str only
         source = StashSource[instance] if isinstance(instance, str) else instance
 
-        return re.match(self.SOURCE_INFOS[source]["regex"], url)
+        return self.classify(url)[1] == source
     
     def whichStashBoxLink(self, url : str) -> StashSource:
         """
         If the url is a link to a StashBox page, return the appropriate StashSource
         """
-        for source in self.SOURCE_INFOS.keys():
-            if self.is_link_to_instance(url, source):
-                return source
-        
-        return None
+        return self.classify(url)[1]
     
-    def getSitesFromDestinationServer(self, destinationEndpoint : Dict) -> None:
-        gql = """
-        query QuerySites {
-            querySites {
-                count
-                sites {
-                    id
-                    url
-                    name
-                    regex
-                    valid_types
-                }
-            }
-        }
+    def _sitesCacheFile(self, destinationEndpoint : Dict) -> str:
+        return f"Cache/{destinationEndpoint['name']}_sites.json"
+
+    def _downloadSites(self, destinationEndpoint : Dict) -> List[Dict]:
         """
-        siteList = callGraphQL(destinationEndpoint, gql)['querySites']['sites']
-        for site in siteList:
-            if 'PERFORMER' in site['valid_types']:
-                self.SITES_MAP.append(site)
-                for source in self.SOURCE_INFOS.keys():
-                    if site['url'].startswith(self.SOURCE_INFOS[source]['url']):
-                        self.SOURCE_INFOS[self.DESTINATION]['siteIds'][source] = site["id"]
-        
+        Downloads the sites of the destination instance and saves them, with the download date
+        """
+        siteList = callGraphQL(destinationEndpoint, GQLQ.QUERY_SITES)['querySites']['sites']
+        filename = self._sitesCacheFile(destinationEndpoint)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename + ".tmp", mode='w', encoding='utf-8') as file:
+            json.dump({"date": datetime.now().isoformat(), "sites": siteList}, file)
+        os.replace(filename + ".tmp", filename)
+        return siteList
+
+    def _refreshSites(self, destinationEndpoint : Dict):
+        try:
+            self._setSites(self._downloadSites(destinationEndpoint))
+        except Exception as e:
+            print(f"Could not refresh the sites of {destinationEndpoint['name']}, keeping the saved ones: {e}")
+
+    def getSitesFromDestinationServer(self, destinationEndpoint : Dict, ttl : timedelta = None) -> None:
+        """
+        Loads the sites of the destination instance.
+
+        Sites saved by a previous run are used straight away. If they are older than ttl, they are downloaded again in the background,
+        and replace the saved ones once received. Sites are only downloaded before returning when none are saved yet.
+
+        ### Parameters
+            - destinationEndpoint (Dict): Endpoint of the destination instance, its 'sites_ttl_hours' is used when ttl is None
+            - ttl (timedelta, optional): Defaults to SITES_CACHE_TTL
+        """
+        if ttl is None:
+            ttl = timedelta(hours=destinationEndpoint["sites_ttl_hours"]) if destinationEndpoint.get("sites_ttl_hours") is not None else SITES_CACHE_TTL
+
+        filename = self._sitesCacheFile(destinationEndpoint)
+        saved = None
+        if os.path.exists(filename):
+            try:
+                with open(filename, mode='r', encoding='utf-8') as file:
+                    saved = json.load(file)
+            except (OSError, json.JSONDecodeError):
+                saved = None
+
+        if saved is None:
+            self._setSites(self._downloadSites(destinationEndpoint))
+            return
+
+        self._setSites(saved["sites"])
+        if datetime.fromisoformat(saved["date"]) < datetime.now() - ttl:
+            threading.Thread(target=self._refreshSites, args=(destinationEndpoint,), daemon=True).start()
 
 
 class StashBoxFilterManager:
@@ -567,6 +1144,21 @@ class StashBoxPerformerManager:
             self.performer = callGraphQL(self.sourceEndpoint, GQLQ.GET_PERFORMER, {'input' : performerId})['findPerformer']
 
         return self.performer
+
+    def getPerformers(self, performerIds : List[str], withEdits : bool = True) -> BatchResult:
+        """
+        Retrieves several performers at once, without storing them in the Manager
+
+        ### Parameters
+            - performerIds ([str]): The performers' IDs in the StashBox instance
+            - withEdits (bool): Also retrieve their edits, when they are not read from the cache
+
+        ### Returns
+            A BatchResult by performer ID. The result is None for a performer that doesn't exist
+        """
+        if self.cache is not None:
+            return BatchResult({performerId : self.cache.getPerformerById(performerId) for performerId in performerIds}, {})
+        return findPerformers(self.sourceEndpoint, performerIds, withEdits=withEdits)
     
     def asDraftInput(self, performer : t.Performer = None) -> t.PerformerDraftInput:
         """
@@ -643,38 +1235,42 @@ class StashBoxPerformerManager:
             - existing ([t.Image], optional): List of already uploaded images, to keep all existing
             - existing ([t.Image], optional): List of images that were removed from the source, to remove them too
         """
+        return runSync(self.uploadPerformerImagesAsync(performer, existing, removed))
+
+    async def uploadPerformerImagesAsync(self, performer : t.Performer = None, existing : List[t.Image] = [], removed : List[t.Image] = []) -> List[str]:
+        """
+        Same as uploadPerformerImages, downloading and uploading the images concurrently
+        """
         if performer is None:
             performer = self.performer
 
         imageIds = []
-        counter = 0
         sourceImgs = performer.get("images", [])
         
         print("Loading existing images")
         
-        existingImgs = {}
-        for img in existing:
-            existingImgs[getImgB64(img["url"])] = img["id"]
-        
-        removedImgs = {}
-        for img in removed:
-            if img:
-                removedImgs[getImgB64(img["url"])] = img["id"]
+        existing = [img for img in existing if img]
+        removed = [img for img in removed if img]
+        downloaded = await asyncio.gather(*[getImgB64Async(img["url"]) for img in existing + removed])
+        existingImgs = {imgB64 : img["id"] for imgB64, img in zip(downloaded[:len(existing)], existing)}
+        removedImgs = {imgB64 : img["id"] for imgB64, img in zip(downloaded[len(existing):], removed)}
 
         # Start with existing images
         for imgB64, id in existingImgs.items():
             if imgB64 not in removedImgs.keys():
                 imageIds.append(id)
 
-        for image in sourceImgs:
-            counter +=1
+        async def upload(counter, image):
             print(f"Uploading image {counter} of {len(sourceImgs)}")
             try:
-                imageId = upload_image(self.destinationEndpoint, image['url'], existingImgs)
-                if imageId:
-                    imageIds.append(imageId["id"])
+                return await upload_image_async(self.destinationEndpoint, image['url'], existingImgs)
             except Exception:
                 print("Error uploading image")
+
+        # gather keeps the order of the source images
+        for imageId in await asyncio.gather(*[upload(counter, image) for counter, image in enumerate(sourceImgs, 1)]):
+            if imageId:
+                imageIds.append(imageId["id"])
         
         return imageIds
     
@@ -713,6 +1309,29 @@ class StashBoxPerformerManager:
                 }
             }
         """
+        input = StashBoxPerformerManager._performerUpdateInput(performerId, performerInput, comment, bot)
+
+        return callGraphQL(self.destinationEndpoint, gql, {'input' : input})['performerEdit']
+
+    def submitPerformerUpdates(self, performerInputs : Dict[str, t.PerformerEditDetailsInput], comment : str, bot : bool = True) -> BatchResult:
+        """
+        Submits a MODIFY edit for several performers, packing up to BATCH_SIZE edits in each request
+
+        ### Parameters
+            - performerInputs (Dict[str, t.PerformerEditDetailsInput]): The new details of each performer, by performer ID
+            - comment (str): The comment of the edits
+            - bot (bool): The edits are submitted by a bot
+
+        ### Returns
+            A BatchResult by performer ID, with the created t.Edit or the error of each edit
+        """
+        return callGraphQLAliased(
+            self.destinationEndpoint, "mutation", "performerEdit", "input", "PerformerEditInput!", "id",
+            {performerId : StashBoxPerformerManager._performerUpdateInput(performerId, performerInput, comment, bot) for performerId, performerInput in performerInputs.items()}
+        )
+
+    @staticmethod
+    def _performerUpdateInput(performerId : str, performerInput : t.PerformerEditDetailsInput, comment : str, bot : bool) -> t.PerformerEditInput:
         edit : t.EditInput = {
             'operation' : 'MODIFY',
             'id' : performerId,
@@ -720,7 +1339,7 @@ class StashBoxPerformerManager:
             'bot' : bot
         }
 
-        input = {
+        return {
             "details" : performerInput,
             "edit" : edit,
             "options": {
@@ -728,8 +1347,6 @@ class StashBoxPerformerManager:
             }
         }
 
-        return callGraphQL(self.destinationEndpoint, gql, {'input' : input})['performerEdit']
-
 class StashBoxPerformerHistory:
     performer : t.Performer
     performerEdits : List[t.PerformerEdit]
@@ -739,7 +1356,15 @@ class StashBoxPerformerHistory:
     removedImages : List[t.Image]
     removedAliases : List[str]
 
-    def __init__(self, stashBoxEndpoint : Dict, performerId : str, cache : StashBoxCache = None, siteMapper : StashBoxSitesMapper = None) -> None:
+    def __init__(self, stashBoxEndpoint : Dict, performerId : str, cache : StashBoxCache = None, siteMapper : StashBoxSitesMapper = None, performer : t.Performer = None) -> None:
+        """
+        ### Parameters
+            - stashBoxEndpoint (Dict): The StashBox endpoint
+            - performerId (str): The performer's ID in the StashBox instance
+            - cache (StashBoxCache, optional): Cache to read the performer and its edits from, instead of the endpoint
+            - siteMapper (StashBoxSitesMapper, optional)
+            - performer (t.Performer, optional): The performer with its edits, if it was already retrieved from the endpoint
+        """
         self.endpoint = stashBoxEndpoint
         self.performerEdits = []
         self.performerStates = {}
@@ -747,20 +1372,53 @@ class StashBoxPerformerHistory:
         self.siteMapper = siteMapper if siteMapper is not None else StashBoxSitesMapper()
         self.removedImages = []
         self.removedAliases = []
-        self._getPerformerWithHistory(performerId)
-        
-    def _getPerformerWithHistory(self, performerId : str) -> t.Performer:
+        self._getPerformerWithHistory(performerId, performer)
+
+    @staticmethod
+    def loadMany(stashBoxEndpoint : Dict, performerIds : List[str], siteMapper : StashBoxSitesMapper = None) -> BatchResult:
+        return runSync(StashBoxPerformerHistory.loadManyAsync(stashBoxEndpoint, performerIds, siteMapper))
+
+    @staticmethod
+    async def loadManyAsync(stashBoxEndpoint : Dict, performerIds : List[str], siteMapper : StashBoxSitesMapper = None) -> BatchResult:
+        """
+        Returns the histories of several performers, looked up with their edits in batches
+
+        ### Parameters
+            - stashBoxEndpoint (Dict): The StashBox endpoint
+            - performerIds ([str]): The performers' IDs in the StashBox instance
+            - siteMapper (StashBoxSitesMapper, optional)
+
+        ### Returns
+            A BatchResult by performer ID. The result is None for a performer that doesn't exist
+        """
+        batch = await findPerformersAsync(stashBoxEndpoint, performerIds)
+        histories = BatchResult({}, dict(batch.errors))
+        for performerId, performer in batch.results.items():
+            if performer is None:
+                histories.results[performerId] = None
+                continue
+            try:
+                histories.results[performerId] = StashBoxPerformerHistory(stashBoxEndpoint, performerId, None, siteMapper, performer)
+            except Exception as e:
+                histories.errors[performerId] = e
+        return histories
+
+    def _getPerformerWithHistory(self, performerId : str, perfData : t.Performer = None) -> t.Performer:
         if self.cache is not None:
             try:
                 self.performer = self.cache.getPerformerById(performerId)
+                if self.performer is None:
+                    raise Exception(f"Performer {performerId} not in cache")
+                # The cache keeps histories apart from the performers, only load it now
+                edits = self.cache.getPerformerEdits(performerId)
             except Exception as e:
                 print("Error - Performer not in cache")
                 raise(e)
         else:
-            perfData : t.Performer = callGraphQL(self.endpoint,GQLQ.GET_PERFORMER, {'input' : performerId})['findPerformer']
+            if perfData is None:
+                perfData = callGraphQL(self.endpoint,GQLQ.GET_PERFORMER, {'input' : performerId})['findPerformer']
             self.performer = perfData
-
-        edits = self.performer.get("edits", [])
+            edits = self.performer.get("edits", [])
 
         if len(edits) == 0:
             # There are no Edits, an issue when the DB was imported initially // Create a fake Edit for the initial submit
@@ -1029,13 +1687,15 @@ class StashBoxPerformerHistory:
             if editChanges['details'].get(attr):
                 newState[attr] = editChanges['details'][attr]
 
+        # Applying an edit twice must not duplicate what it added: edits closed while a cache was downloaded are replayed by the next refresh
         for attr in ["added_aliases", "added_tattoos", "added_piercings", "added_images", "added_urls"]:
             if editChanges['details'].get(attr):
                 for x in editChanges['details'].get(attr):
                     key = attr.split('_')[1]
                     if key not in newState or newState[key] == None:
                         newState[key] = []
-                    newState[key].append(x)
+                    if not StashBoxPerformerHistory._containsItem(newState[key], x, key):
+                        newState[key].append(x)
 
         for attr in ["removed_aliases", "removed_tattoos", "removed_piercings", "removed_urls"]:
             if editChanges['details'].get(attr):
@@ -1047,58 +1707,126 @@ class StashBoxPerformerHistory:
             for x in editChanges['details'].get("removed_images"):
                 if x is None:
                     continue
-                existingImg = [img for img in newState["images"] if img and img["id"] == x["id"]][0]
-                newState["images"].remove(existingImg)
+                existingImg = [img for img in newState["images"] if img and img["id"] == x["id"]]
+                if existingImg:
+                    newState["images"].remove(existingImg[0])
         
         return newState
+
+    @staticmethod
+    def _containsItem(items : List, item, key : str) -> bool:
+        """
+        Returns True if item is already in items. Images are compared by id and urls by address, their other fields may differ
+        """
+        if key == "images" and item is not None:
+            return any(existing and existing.get("id") == item.get("id") for existing in items)
+        if key == "urls" and item is not None:
+            return any(existing and existing.get("url") == item.get("url") for existing in items)
+        return item in items
     
+# Changes are downloaded from a bit before the cache date, to cover clock differences with the server
+REFRESH_OVERLAP = timedelta(days=1)
+
 class StashBoxCacheManager:
     cache : StashBoxCache
+    editLog : StashBoxEditLog
     saveToFile = True
     stashBoxConnectionParams = {}
     
 
-    def __init__(self, stashBoxConnection : dict, saveToFile = True) -> None:
-        self.cache = StashBoxCache(stashBoxConnection['name'])
+    def __init__(self, stashBoxConnection : dict, saveToFile = True, backend = "file", profile = "history") -> None:
+        """
+        ### Parameters
+            - stashBoxConnection (dict): The StashBox endpoint
+            - saveToFile (bool): Should the cache be saved after every load / refresh
+            - backend (str): "file" for a compressed file loaded in memory, "sqlite" for a SQLite database queried on demand
+            - profile (str): Cheapest query profile the cache must be downloaded with, see GQLQ.QUERY_PROFILES.
+            A cache saved with a cheaper profile is downloaded again, one saved with a more complete profile is used as is
+
+        Every edit downloaded, on its own or in a performer's history, is kept in the edit log of the instance.
+        Performer records are cached without their edits, the cache reads them back from the log
+        """
+        self.profile = profile
+        if backend == "sqlite":
+            self.cache = StashBoxSQLiteCache(stashBoxConnection['name'])
+        else:
+            self.cache = StashBoxCache(stashBoxConnection['name'])
+        self.editLog = StashBoxEditLog(stashBoxConnection['name'])
+        self.cache.editLog = self.editLog
         self.saveToFile = saveToFile
         self.stashBoxConnectionParams = stashBoxConnection
     
-    def loadCache(self, useFile = True, limitHours = 24, refreshLimitDays = 7):
+    def loadCache(self, useFile = True, limitHours = 24, refreshLimitDays = 7, lazy = False):
+        """
+        ### Parameters
+            - useFile (bool): Start from the cache saved on disk, and refresh it if needed
+            - limitHours (int): Age under which the cache is considered up to date
+            - refreshLimitDays (int): Age over which the performers updated since are downloaded, instead of replaying the edits one by one
+            - lazy (bool): Don't load the cache file in memory unless it needs a refresh, performers are streamed from it by cache.iterPerformers()
+        """
         if useFile:
-            self.cache.loadCacheFromFile()
+            self.cache.loadCacheFromFile(lazy)
             self.updateCache(limitHours, refreshLimitDays)
         else:
             self.loadCacheFromStashBox()
 
     def loadCacheFromStashBox(self):
-        self.cache.performers = getAllPerformers(self.stashBoxConnectionParams)
-        self.cache.cacheDate = datetime.now()
+        """
+        Downloads all performers. An interrupted download is resumed from its last saved page
+        """
+        # Edits closed from now on are not included in the download, the next refresh starts from them
+        checkpoint = StashBoxDownloadCheckpoint(self.stashBoxConnectionParams['name'], self.profile, getLatestEditClosed(self.stashBoxConnectionParams))
+        self.cache.setPerformers(getAllPerformers(self.stashBoxConnectionParams, checkpoint=checkpoint, profile=self.profile))
+        self.cache.profile = self.profile
+        self.cache.editWatermark = checkpoint.editWatermark
+        # The cache is as old as its first page, later refreshes must include the changes made while downloading
+        self.cache.cacheDate = checkpoint.started
+        if self.saveToFile:
+            self.cache.saveCacheToFile()
+        checkpoint.clear()
 
     def updateCache(self, limitHours = 24, refreshLimitDays = 7):
         dateLimit = datetime.now() - timedelta(hours=limitHours)
         dateRefreshLimit = datetime.now() - timedelta(days=refreshLimitDays)
 
+        profiles = list(GQLQ.QUERY_PROFILES.keys())
+        if profiles.index(self.cache.profile) < profiles.index(self.profile):
+            print(f"Existing cache only has the {self.cache.profile} fields, grabbing a brand new one with the {self.profile} fields")
+            self.loadCacheFromStashBox()
+            return
+
         if self.cache.cacheDate >= dateLimit:
             # Cache is already up to date
             print("Cache is up to date")
             return
         
-        if self.cache.cacheDate < dateRefreshLimit:
-            # Cache is too old to refresh, do a full reload
-            print("Existing cache file is too old, grabbing a brand new one")
+        if self.cache.cacheDate == NO_CACHE_DATE:
+            print("There is no cache yet, grabbing a brand new one")
             self.loadCacheFromStashBox()
-            if self.saveToFile:
-                self.cache.saveCacheToFile()
+            return
+
+        if self.cache.cacheDate < dateRefreshLimit:
+            # Too many edits to replay one by one, download the performers changed since instead
+            print("Existing cache file is old, downloading the performers updated since")
+            self.refreshUpdatedPerformers()
             return
         
         # Cache can be refreshed, load all the recent Edits and apply them
         print("Existing cache file is outdated, updating it with latest changes")
-        allEdits = getAllEdits(self.stashBoxConnectionParams, refreshLimitDays)
-        allEditsFiltered = list(filter(lambda edit: stashDateToDateTime(edit["closed"]) >= self.cache.cacheDate, allEdits))
-        allEditsFiltered.reverse()
-        print(f"{len(allEditsFiltered)} changes to process")
+        refreshDate = datetime.now()
+        if self.cache.editWatermark is not None:
+            # Edits closed in the same second as the watermark are downloaded again, drop the ones already replayed
+            knownIds = self.editLog.getEditIdsClosedAt(self.cache.editWatermark)
+            allEdits = getEditsSince(self.stashBoxConnectionParams, watermark=self.cache.editWatermark, knownIds=knownIds)
+        else:
+            # Caches saved before edit watermarks existed
+            allEdits = getEditsSince(self.stashBoxConnectionParams, since=self.cache.cacheDate)
+        # Apply the oldest edits first
+        allEdits.reverse()
+        print(f"{len(allEdits)} changes to process")
+        self.editLog.addEdits(allEdits)
 
-        for edit in allEditsFiltered:
+        for edit in allEdits:
             targetPerformerId = edit["target"]["id"]
             print(f"{edit['operation']} on {targetPerformerId}")
 
@@ -1108,25 +1836,69 @@ class StashBoxCacheManager:
                 perf["updated"] = edit["closed"]
                 perf["created"] = edit["target"]["created"]
                 perf["deleted"] = False
-                self.cache.performers.append(perf)
+                self.cache.addPerformer(perf)
             elif edit["operation"] == "DESTROY":
                 self.cache.deletePerformerById(targetPerformerId)
             elif edit["operation"] == "MODIFY" or edit["operation"] == "MERGE":
-                performerIdx = self.cache._getPerformerIdxById(targetPerformerId)
-                if performerIdx is None:
+                cachedPerf = self.cache.getPerformerById(targetPerformerId)
+                if cachedPerf is None:
                     # Perf can be None if it was recently merged / deleted and an Edit was already in the queue for it. In that case, ignore it
                     continue
-                self.cache.performers[performerIdx] = StashBoxPerformerHistory.applyPerformerUpdate(self.cache.performers[performerIdx], edit)
-                perf = self.cache.performers[performerIdx]
+                perf = StashBoxPerformerHistory.applyPerformerUpdate(cachedPerf, edit)
                 perf["updated"] = edit["closed"]
 
+                mergedIds = None
                 if edit["operation"] == "MERGE":
                     mergedIds = list(map( lambda source: source["id"] ,edit["merge_sources"]))
-                    for id in mergedIds:
-                        self.cache.deletePerformerById(id)
+                self.cache.replacePerformer(perf, mergedIds)
         
+        if len(allEdits) > 0:
+            self.cache.editWatermark = allEdits[-1]["closed"]
+        self.cache.cacheDate = refreshDate
+        if self.saveToFile:
+            self.cache.saveCacheToFile()
+
+    def refreshUpdatedPerformers(self):
+        """
+        Refreshes the cache with the performers updated since its date, then removes the performers deleted or merged since
+        """
+        refreshDate = datetime.now()
+        since = self.cache.cacheDate - REFRESH_OVERLAP
+        editWatermark = getLatestEditClosed(self.stashBoxConnectionParams)
+
+        # The cache profile may be more complete than required, keep it
+        updatedPerformers = getPerformersUpdatedSince(self.stashBoxConnectionParams, since, self.cache.profile)
+        print(f"{len(updatedPerformers)} performers updated since {since}")
+        for perf in updatedPerformers:
+            if self.cache.getPerformerById(perf["id"]) is None:
+                self.cache.addPerformer(perf)
+            else:
+                # The performers merged into it are removed below, from the MERGE edits
+                self.cache.replacePerformer(perf, None)
+
+        # Deleted performers are not listed any more, find them through their edits
+        destroyEdits, mergeEdits = runSync(self._getRemovalEditsAsync(since))
+        self.editLog.addEdits(destroyEdits + mergeEdits)
+        removedIds = [edit["target"]["id"] for edit in destroyEdits]
+        for edit in mergeEdits:
+            removedIds.extend([source["id"] for source in edit["merge_sources"] or []])
+        print(f"{len(removedIds)} performers deleted or merged since {since}")
+        for performerId in removedIds:
+            self.cache.deletePerformerById(performerId)
+
+        self.cache.editWatermark = editWatermark
+        self.cache.cacheDate = refreshDate
         if self.saveToFile:
             self.cache.saveCacheToFile()
 
+    async def _getRemovalEditsAsync(self, since : datetime) -> Tuple[List[t.PerformerEdit], List[t.PerformerEdit]]:
+        """
+        Downloads the DESTROY and the MERGE edits closed since a date, both at once
+        """
+        return tuple(await asyncio.gather(
+            getEditsSinceAsync(self.stashBoxConnectionParams, since, "DESTROY"),
+            getEditsSinceAsync(self.stashBoxConnectionParams, since, "MERGE")
+        ))
+
     def saveCache(self):
         self.cache.saveCacheToFile()
@@ -49,6 +49,28 @@ query QueryPerformers($input: PerformerQueryInput!) {
 }
 """
 
+GET_ALL_PERFORMERS_LISTING = """
+query QueryPerformers($input: PerformerQueryInput!) {
+    queryPerformers(input: $input) {
+        count
+        performers {
+        ... PerformerListingFragment
+        }
+    }
+}
+"""
+
+GET_ALL_PERFORMERS_COMPARISON = """
+query QueryPerformers($input: PerformerQueryInput!) {
+    queryPerformers(input: $input) {
+        count
+        performers {
+        ... PerformerFragment
+        }
+    }
+}
+"""
+
 GET_ALL_PERFORMER_EDITS = """
     query QueryEdits($input: EditQueryInput!) {
   queryEdits(input: $input) {
@@ -76,6 +98,78 @@ GET_ALL_PERFORMER_EDITS = """
 """
 
 
+QUERY_SITES = """
+query QuerySites {
+  querySites {
+    count
+    sites {
+      id
+      url
+      name
+      regex
+      valid_types
+    }
+  }
+}
+"""
+
+GET_EDITS_INDEX = """
+query QueryEdits($input: EditQueryInput!) {
+  queryEdits(input: $input) {
+    count
+    edits {
+      id
+      status
+      operation
+      created
+      updated
+      closed
+      target {
+        ... on Performer {
+          id
+        }
+      }
+    }
+  }
+}
+"""
+
+FRAG_PERF_LISTING = """
+fragment PerformerListingFragment on Performer {
+  aliases
+  band_size
+  breast_type
+  career_end_year
+  career_start_year
+  country
+  cup_size
+  disambiguation
+  ethnicity
+  eye_color
+  gender
+  hair_color
+  height
+  hip_size
+  name
+  urls {
+    site {
+      id
+    }
+    url
+  }
+  waist_size
+  id
+  merged_ids
+  birth_date
+  birthdate {
+    date
+  }
+  created
+  updated
+  deleted
+}
+"""
+
 FRAG_PERF = """
 fragment PerformerFragment on Performer {
   aliases
@@ -232,11 +326,19 @@ fragment PerformerFragmentWidthEdits on Performer {
 """
 
 FRAGMENTS = {
+    "PerformerListingFragment" : FRAG_PERF_LISTING,
     "PerformerFragment" : FRAG_PERF,
     "PerformerEditFragment" : FRAG_PERFEDIT,
     "PerformerFragmentWidthEdits" : FRAG_PERF_WITH_EDITS
 }
 
-
-
-
+# Queries downloading all performers, from the cheapest to the most complete
+# - listing: the attributes compared by comparePerformers, without images, piercings and tattoos.
+#   Enough to filter, match and find performers, not to build edits
+# - comparison: all attributes, enough to compare performers and build edits
+# - history: all attributes and the full edit history
+QUERY_PROFILES = {
+    "listing" : GET_ALL_PERFORMERS_LISTING,
+    "comparison" : GET_ALL_PERFORMERS_COMPARISON,
+    "history" : GET_ALL_PERFORMERS
+}